@@ -1,75 +1,574 @@
 import asyncio
+import glob
+import heapq
 import json
-from telegram import Update, InputMediaPhoto, InputMediaVideo, InputMediaDocument, Sticker
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import Forbidden
+import logging
+import os
+import signal
+import time
+from collections import OrderedDict
+from telegram import ChatMember, Update, InputMediaPhoto, InputMediaVideo, InputMediaDocument, Sticker
+from telegram.ext import ApplicationBuilder, ChatMemberHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from telegram.error import Forbidden, RetryAfter, BadRequest, NetworkError, TelegramError
+from telegram.request import HTTPXRequest
+import broadcast_engine
+from broadcast_engine import Broadcast, write_json
+from auth_index import AuthIndex
+from outbound_queue import OutboundQueue, TokenBucket, DELETE, SEND, BULK, READ, OUTBOUND_RATE
+from metrics import Counter, Histogram, CallbackMetric, MetricsServer, monitor_loop_lag
+from webhook_server import WebhookServer
+from sharding import Coordinator, ShardLink, shard_of
+from structured_log import LogPipeline
 
 # Default auto delete time in seconds (30 minutes)
+DEFAULT_AUTO_DELETE_TIME = 30 * 60
 OWNER_ID = '7574316340'  # Replace this with the actual owner ID
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "7738387262:AAFlJILd8J2BupXtBGBhSOYpKr3Uf5diP-s")
+BOT_API_URL = os.environ.get("BOT_API_URL")  # Point at a fake Bot API for offline testing
+AUTH_BLOOM_BITS = int(os.environ.get("AUTH_BLOOM_BITS", str(1 << 21)))  # Bloom prefilter size for large auth indexes, 0 disables it
+
+# Sharded mode sets these in each shard process before any state is loaded, see serve_sharded()
+SHARD_ID = int(os.environ["BOT_SHARD"]) if "BOT_SHARD" in os.environ else None
+SHARD_COUNT = int(os.environ.get("BOT_SHARDS", "1"))
+shard_link = None  # ShardLink in a shard process
+
+# data.json is data.2.json in shard 2, each shard keeps the state of its own chats
+def shard_file(path, shard=SHARD_ID):
+    if shard is None:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}.{shard}{ext}"
+
+broadcast_engine.BROADCAST_JOB_FILE = shard_file(broadcast_engine.BROADCAST_JOB_FILE)
+broadcast_engine.BROADCAST_PROGRESS_FILE = shard_file(broadcast_engine.BROADCAST_PROGRESS_FILE)
+
+# Logging
+# JSON lines on stdout, written by a background thread, see structured_log.py.
+# LOG_LEVEL=DEBUG adds per-message detail such as skipped auto-deletes.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+log = logging.getLogger("copyrightsaver")
+log_pipeline = LogPipeline(log, LOG_LEVEL, fields={"shard": SHARD_ID} if SHARD_ID is not None else None)
+
+# Metrics
+# Counters and histograms for /stats and, with METRICS_PORT set, a local
+# Prometheus endpoint. API calls are timed by InstrumentedRequest below.
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # 0 disables the /metrics endpoint
+if SHARD_ID is not None and METRICS_PORT:
+    METRICS_PORT += SHARD_ID  # One endpoint per shard
+
+started_at = time.monotonic()
+update_seconds = Histogram("bot_update_seconds", "Time spent routing one update", ("route",))
+api_seconds = Histogram("bot_api_request_seconds", "Bot API request latency", ("method",))
+api_errors = Counter("bot_api_errors_total", "Bot API requests that raised", ("method", "error"))
+deletion_lateness = Histogram("bot_deletion_lateness_seconds", "Time between a deletion's due time and sending it",
+                              buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 900))
+save_seconds = Histogram("bot_save_data_seconds", "Time to write a data snapshot")
+loop_lag = Histogram("bot_event_loop_lag_seconds", "How late the event loop woke from a 0.5s sleep")
+CallbackMetric("bot_pending_deletions", "Messages waiting in the deletion heap", "gauge",
+               lambda: len(pending_deletions))
+CallbackMetric("bot_deletions_total", "Messages by deletion outcome", "counter",
+               lambda: {"deleted": deletion_metrics["messages"], "failed": deletion_metrics["failed"],
+                        "retried": deletion_metrics["retried"]}, ("result",))
+CallbackMetric("bot_deletion_batches_total", "deleteMessages calls that succeeded", "counter",
+               lambda: deletion_metrics["batches"])
+CallbackMetric("bot_outbound_queued", "Requests waiting in the outbound queue", "gauge",
+               lambda: dict(zip(("delete", "send", "bulk", "read"), outbound.queued())), ("priority",))
+CallbackMetric("bot_outbound_requests_total", "Outbound queue requests by outcome", "counter",
+               lambda: dict(outbound.metrics), ("result",))
+CallbackMetric("bot_pending_edit_announcements", "Chats with an edit announcement being gathered", "gauge",
+               lambda: len(pending_edits))
+CallbackMetric("bot_dead_chats", "Chats skipped as unreachable", "gauge", lambda: count_dead_chats())
+CallbackMetric("bot_startup_seconds", "Time the last startup spent in each phase", "gauge",
+               lambda: startup_seconds, ("phase",))
+CallbackMetric("bot_log_records_skipped_total", "Log records not written", "counter",
+               lambda: {"dropped": log_pipeline.dropped, "rate_limited": log_pipeline.suppressed}, ("reason",))
+
+# Per-chat settings
+# Configs are small immutable objects keyed by int chat ID. Chats without
+# settings share one default object, so a lookup never allocates. Changes
+# build a new object and swap it in (copy-on-write).
+class ChatConfig:
+    __slots__ = ("delete_timer", "auto_delete")
+
+    def __init__(self, delete_timer=DEFAULT_AUTO_DELETE_TIME, auto_delete=True):
+        object.__setattr__(self, "delete_timer", int(delete_timer))
+        object.__setattr__(self, "auto_delete", bool(auto_delete))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ChatConfig is immutable, use replace()")
+
+    def __eq__(self, other):
+        return (isinstance(other, ChatConfig) and self.delete_timer == other.delete_timer
+                and self.auto_delete == other.auto_delete)
+
+    def __repr__(self):
+        return f"ChatConfig(delete_timer={self.delete_timer}, auto_delete={self.auto_delete})"
+
+    def replace(self, **changes):
+        return ChatConfig(changes.get("delete_timer", self.delete_timer),
+                          changes.get("auto_delete", self.auto_delete))
+
+    def to_dict(self):
+        return {"delete_timer": self.delete_timer, "auto_delete": self.auto_delete}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("delete_timer", DEFAULT_AUTO_DELETE_TIME), data.get("auto_delete", True))
+
+
+class ChatConfigTable:
+    def __init__(self, default=None):
+        self.default = default or ChatConfig()  # Shared by every chat without its own settings
+        self.configs = {}
+
+    def __len__(self):
+        return len(self.configs)
+
+    def get(self, chat_id):
+        return self.configs.get(chat_id, self.default)
+
+    def set(self, chat_id, config):
+        self.configs[int(chat_id)] = config
+
+    def update(self, chat_id, **changes):
+        config = self.get(chat_id).replace(**changes)
+        self.set(chat_id, config)
+        return config
+
+    # Bulk load (chat_id, {"delete_timer": ..., "auto_delete": ...}) pairs, IDs may be strings from JSON
+    def preload(self, settings):
+        self.configs.update((int(chat_id), ChatConfig.from_dict(data)) for chat_id, data in settings)
+
+    def to_dict(self):
+        return {chat_id: config.to_dict() for chat_id, config in self.configs.items()}
+
 authorized_users = set()
 authorized_user_ids = set()
 started_users = set()  # Track users who started the bot
 group_ids = set()  # Track groups where the bot is added
-global_authorized_users = set()  # Users globally authorized by the owner
-group_authorized_users = {}  # Group-specific authorizations
-group_settings = {}  # Store auto-delete settings per group
+auth_index = AuthIndex(AUTH_BLOOM_BITS)  # Global and group-specific authorizations
+group_settings = ChatConfigTable()  # Store auto-delete settings per group
+dead_chats = {}  # chat_id -> [reason, was_user, was_group] for chats the bot can't reach
 
 # Update Load and Save Functions
-DATA_FILE = "data.json"
+DATA_FILE = shard_file("data.json")
 
 # Load data from the JSON file
 def load_data():
     try:
-        with open(DATA_FILE, "r") as file:
+        with open(DATA_FILE, "rb") as file:
             content = file.read().strip()
             if not content:  # If the file is empty
-                print(f"{DATA_FILE} is empty. Creating default data.")
+                log.warning("%s is empty. Creating default data.", DATA_FILE)
                 return {}
             return json.loads(content)  # Try parsing JSON if file is not empty
     except json.JSONDecodeError as e:
-        print(f"Error loading JSON: {e}")
+        log.error("Error loading JSON: %s", e)
         return {}  # Return an empty dictionary in case of error
     except FileNotFoundError:
-        print(f"{DATA_FILE} not found, creating a new file.")
+        log.info("%s not found, starting with empty data.", DATA_FILE)
         return {}  # Return an empty dictionary if file doesn't exist
 
-# Function to save data to JSON file
-def save_data():
-    data = {
+# Write-ahead log
+# Every mutation is appended to WAL_FILE as one JSON line instead of rewriting
+# DATA_FILE. A background writer flushes and fsyncs the log in batches, and
+# folds it into a fresh DATA_FILE snapshot once it grows past WAL_COMPACT_ENTRIES.
+WAL_FILE = shard_file("data.wal")
+WAL_FLUSH_INTERVAL = 1.0  # Seconds between batched log flushes
+WAL_COMPACT_ENTRIES = 10000  # Log entries before compacting into a snapshot
+
+wal_buffer = []  # Encoded log lines not yet written to WAL_FILE
+wal_entries = 0  # Log lines written to WAL_FILE since the last snapshot
+
+# Build the snapshot in the same format load_data() reads
+def snapshot_data():
+    return {
         "started_users": list(started_users),
         "group_ids": list(group_ids),
         "authorized_users": list(authorized_users),
         "authorized_user_ids": list(authorized_user_ids),
-        "global_authorized_users": list(global_authorized_users),
-        "group_authorized_users": {k: list(v) for k, v in group_authorized_users.items()},  # Convert sets to lists
-        "group_settings": group_settings  # Keep it as a dictionary
+        "global_authorized_users": auth_index.global_list(),
+        "group_authorized_users": auth_index.chat_lists(),
+        "group_settings": group_settings.to_dict(),  # Keep it as a dictionary
+        # A copy, the snapshot is serialised in a thread while handlers keep changing dead_chats
+        "dead_chats": {chat_id: list(entry) for chat_id, entry in dead_chats.items()},
     }
 
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+# Atomically replace DATA_FILE with a snapshot and start an empty log
+def write_snapshot(data):
+    tmp_file = DATA_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, DATA_FILE)
+    with open(WAL_FILE, "w") as f:
+        f.flush()
+        os.fsync(f.fileno())
+
+def append_wal(lines):
+    with open(WAL_FILE, "a") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+# Function to save data to JSON file
+def save_data():
+    global wal_entries
+    started = time.perf_counter()
+    wal_buffer.clear()  # The snapshot already contains every buffered change
+    write_snapshot(snapshot_data())
+    wal_entries = 0
+    save_seconds.observe(time.perf_counter() - started)
+
+# Record a single change, e.g. log_change("add", "started_users", user_id)
+def log_change(op, *args):
+    wal_buffer.append(json.dumps([op, *args]) + "\n")
+
+def apply_change(record):
+    op, *args = record
+    if op == "add" and args[0] == "global_authorized_users":
+        auth_index.add_global(args[1])
+    elif op == "discard" and args[0] == "global_authorized_users":
+        auth_index.discard_global(args[1])
+    elif op == "add":
+        globals()[args[0]].add(args[1])
+    elif op == "discard":
+        globals()[args[0]].discard(args[1])
+    elif op == "auth_add":
+        auth_index.add_in_chat(args[0], args[1])
+    elif op == "settings":
+        group_settings.set(args[0], ChatConfig.from_dict(args[1]))
+    elif op == "dead":
+        chat_id, entry = args
+        started_users.discard(chat_id)
+        group_ids.discard(chat_id)
+        dead_chats[chat_id] = entry
+    elif op == "alive":
+        entry = dead_chats.pop(args[0], None)
+        if entry and entry[1]:
+            started_users.add(args[0])
+        if entry and entry[2]:
+            group_ids.add(args[0])
+
+# Replay changes logged after the last snapshot
+def replay_wal():
+    global wal_entries
+    try:
+        with open(WAL_FILE, "r") as f:
+            for line in f:
+                try:
+                    apply_change(json.loads(line))
+                except (json.JSONDecodeError, ValueError) as e:
+                    # A crash can leave a half-written last line
+                    log.warning("Skipping bad %s entry: %s", WAL_FILE, e)
+                    continue
+                wal_entries += 1
+    except FileNotFoundError:
+        pass
+
+# Runs until stop is set. It is never cancelled, so a flush is never cut off halfway.
+async def wal_writer(stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=WAL_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            await flush_wal(loop)
+
+async def flush_wal(loop):
+    global wal_entries
+    if not wal_buffer:
+        return
+    lines = wal_buffer[:]
+    wal_buffer.clear()
+    try:
+        if wal_entries + len(lines) >= WAL_COMPACT_ENTRIES:
+            # The snapshot is built on the event loop so it matches memory exactly
+            started = time.perf_counter()
+            await loop.run_in_executor(None, write_snapshot, snapshot_data())
+            wal_entries = 0
+            save_seconds.observe(time.perf_counter() - started)
+        else:
+            await loop.run_in_executor(None, append_wal, lines)
+            wal_entries += len(lines)
+    except Exception as e:
+        # Keep the lines for the next flush. A failed append may have left half a
+        # line in WAL_FILE, so the next flush writes a snapshot, which starts a new log.
+        log.error("Error writing %s, retrying: %s", WAL_FILE, e)
+        wal_buffer[:0] = lines
+        wal_entries = WAL_COMPACT_ENTRIES
+
+# Cancel a background task and wait until it has finished cleaning up
+async def cancel_task(task):
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+# Let a task that was asked to stop finish on its own for up to timeout seconds, then cancel it
+async def finish_task(task, timeout):
+    if task is None:
+        return
+    done, _ = await asyncio.wait({task}, timeout=timeout)
+    if not done:
+        log.warning("%s did not finish within the shutdown drain time, cancelling it.", task.get_coro().__name__)
+        await cancel_task(task)
+    elif not task.cancelled() and task.exception():
+        log.error("%s failed during shutdown: %s", task.get_coro().__name__, task.exception())
+
+async def start_wal_writer(application):
+    if store:  # SQLite commits its own changes
+        return
+    stop = application.bot_data["wal_stop"] = asyncio.Event()
+    application.bot_data["wal_task"] = asyncio.create_task(wal_writer(stop))
+
+async def stop_wal_writer(application):
+    if store:
+        store.close()
+        return
+    task = application.bot_data.pop("wal_task", None)
+    if task:
+        application.bot_data.pop("wal_stop").set()
+        await task
+    # Fold the log into the snapshot, unless nothing changed since the last one
+    if wal_buffer or wal_entries:
+        try:
+            save_data()
+        except Exception as e:  # Let the rest of shutdown run, the WAL still holds what was flushed
+            log.error("Error writing %s at shutdown: %s", DATA_FILE, e)
 # Function to authorize a user and add them to the list
 def authorize_user(user_id):
     if user_id not in authorized_user_ids:
         authorized_user_ids.add(user_id)  # Add to set to prevent duplicates
         authorized_users.append(user_id)  # You can also keep the list for other purposes
-        print(f"User {user_id} authorized!")
+        log.info("User %s authorized!", user_id, extra={"user_id": user_id})
     else:
-        print(f"User {user_id} is already authorized.")
+        log.info("User %s is already authorized.", user_id, extra={"user_id": user_id})
+
+# Storage backend: "json" keeps everything in the sets above backed by DATA_FILE
+# and WAL_FILE, "sqlite" keeps it in SQLITE_FILE and loads nothing into memory.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_FILE = shard_file("data.db")
+store = None  # SQLiteStore when STORAGE_BACKEND is "sqlite"
+
+# Initialize the data (loading from the file and replaying the log)
+def load_json_state():
+    global started_users, group_ids, authorized_users, authorized_user_ids
+    global dead_chats
+    data = load_data()
+    started_users = set(data.get("started_users", []))  # Use a set for uniqueness
+    group_ids = set(data.get("group_ids", []))
+    authorized_users = data.get("authorized_users", [])
+    authorized_user_ids = set(data.get("authorized_user_ids", []))  # Store as set
+    auth_index.build(data.get("global_authorized_users", []), data.get("group_authorized_users", {}).items())
+    group_settings.preload(data.get("group_settings", {}).items())
+    dead_chats = {int(k): v for k, v in data.get("dead_chats", {}).items()}
+    replay_wal()
+
+# Nothing is read at import. The state is loaded by the first phase of
+# on_startup(), or by whatever needs it first, e.g. split_into_shards(). The
+# snapshot is not rewritten on load: changes since it are replayed from
+# WAL_FILE and folded back in on shutdown or once the log is long enough.
+state_loaded = False
+
+def load_state():
+    global store, state_loaded
+    if state_loaded:
+        return
+    if SHARD_ID is None:
+        refuse_split_state()
+    if STORAGE_BACKEND == "sqlite":
+        from sqlite_store import SQLiteStore
+
+        store = SQLiteStore(SQLITE_FILE)
+        if store.is_empty():  # First start on SQLite: import the existing data file
+            load_json_state()
+            store.import_data(snapshot_data())
+        store.config_changed()  # Note the version being loaded
+        load_store_config()
+    else:
+        load_json_state()
+    state_loaded = True
+
+# Settings and authorizations are preloaded from SQLite, and loaded again when another worker changed them
+def load_store_config():
+    group_settings.configs.clear()
+    group_settings.preload(store.iter_group_configs())
+    auth_index.build(store.iter_global_auth(), store.iter_group_auth())
+
+async def start_state(application):
+    load_state()
+
+# State access
+# Handlers go through these helpers so they work with either storage backend.
+
+def add_started_user(user_id):
+    if store:
+        return store.add_started_user(user_id)
+    if user_id in started_users:
+        return False
+    started_users.add(user_id)
+    log_change("add", "started_users", user_id)
+    return True
+
+# Record a user who sent /start, on the shard that owns their private chat
+def note_started_user(user_id):
+    if shard_link and not shard_link.owns(user_id):
+        shard_link.forward(user_id, "note_started_user", user_id)
+        return False
+    reactivate_chat(user_id)
+    return add_started_user(user_id)
+
+def add_group(chat_id):
+    if store:
+        return store.add_group(chat_id)
+    if chat_id in group_ids:
+        return False
+    group_ids.add(chat_id)
+    log_change("add", "group_ids", chat_id)
+    return True
+
+def count_started_users():
+    if store:
+        return store.count_started_users()
+    return len(started_users)
+
+def count_groups():
+    if store:
+        return store.count_groups()
+    # Group and supergroup IDs are negative, private chats are positive
+    return sum(1 for chat_id in group_ids if chat_id < 0)
+
+def get_group_chat_ids():
+    if store:
+        return list(store.iter_groups())
+    return [chat_id for chat_id in group_ids if chat_id < 0]
+
+def get_recipients():
+    if store:
+        return list(store.iter_recipients())
+    return list(started_users | group_ids)
+
+# Authorizations for both backends are answered by auth_index, storage only keeps them durable
+def is_exempt(chat_id, user_id):
+    return auth_index.is_exempt(chat_id, user_id)
+
+def authorize_global(user_id):
+    if not auth_index.add_global(user_id):
+        return
+    if store:
+        store.authorize_global(user_id)
+    else:
+        log_change("add", "global_authorized_users", user_id)
+
+def authorize_in_group(chat_id, user_id):
+    if not auth_index.add_in_chat(chat_id, user_id):
+        return
+    if store:
+        store.authorize_in_group(chat_id, user_id)
+    else:
+        log_change("auth_add", chat_id, user_id)
 
-# Initialize the data (loading from the file)
-data = load_data()
-started_users = set(data.get("started_users", []))  # Use a set for uniqueness
-group_ids = set(data.get("group_ids", []))
-authorized_users = data.get("authorized_users", [])
-authorized_user_ids = set(data.get("authorized_user_ids", []))  # Store as set
-global_authorized_users = set(data.get("global_authorized_users", []))
-group_authorized_users = {k: set(v) for k, v in data.get("group_authorized_users", {}).items()}  # Convert lists to sets
-group_settings = data.get("group_settings", {})
+def unauthorize_global(user_id):
+    if not auth_index.discard_global(user_id):
+        return False
+    if store:
+        store.unauthorize_global(user_id)
+    else:
+        log_change("discard", "global_authorized_users", user_id)
+    return True
 
+# Settings for both backends live in group_settings, storage only keeps them durable
+def get_group_config(chat_id):
+    return group_settings.get(chat_id)
 
+def update_group_config(chat_id, **changes):
+    config = group_settings.update(chat_id, **changes)
+    if store:
+        store.set_group_config(chat_id, config.to_dict())
+    else:
+        log_change("settings", chat_id, config.to_dict())
+    return config
+
+# Recipient health
+# Chats that block the bot, remove it or no longer exist are moved out of
+# started_users and group_ids into dead_chats, so broadcasts stop paying a
+# failing API call for them. They are restored as soon as they interact again.
+DEAD_AFTER_FAILURES = 3  # Consecutive unexplained failures before a chat counts as dead
+
+send_failures = {}  # chat_id -> consecutive failed sends
+
+# Return a reason if the error means the chat can never be reached again
+def permanent_failure_reason(error):
+    if isinstance(error, Forbidden):
+        return str(error)
+    if isinstance(error, BadRequest) and "chat not found" in str(error).lower():
+        return str(error)
+    return None
+
+# Errors that say nothing about whether the chat is still there: local queue
+# back-pressure, rate limits, network trouble and missing rights
+def is_transient_failure(error):
+    if not isinstance(error, TelegramError) or isinstance(error, RetryAfter):
+        return True
+    if isinstance(error, BadRequest):  # A subclass of NetworkError, but answered by Telegram
+        return "not enough rights" in str(error).lower()
+    return isinstance(error, NetworkError)
 
-# Save data after making changes
-save_data()
+def is_dead_chat(chat_id):
+    if store:
+        return store.is_dead(chat_id)
+    return chat_id in dead_chats
+
+def mark_dead(chat_id, reason):
+    if is_dead_chat(chat_id):  # Keep what it was when it died, reactivating restores that
+        return
+    log.info("Marking chat %s as dead: %s", chat_id, reason, extra={"chat_id": chat_id})
+    group_index.pop(chat_id, None)
+    if store:
+        store.mark_dead(chat_id, reason)
+        return
+    record = ["dead", chat_id, [reason, chat_id in started_users, chat_id in group_ids]]
+    apply_change(record)
+    log_change(*record)
+
+def reactivate_chat(chat_id):
+    send_failures.pop(chat_id, None)  # A chat sending traffic is reachable, whatever earlier sends hit
+    if not is_dead_chat(chat_id):
+        return
+    log.info("Chat %s is active again.", chat_id, extra={"chat_id": chat_id})
+    if store:
+        store.reactivate(chat_id)
+        return
+    apply_change(["alive", chat_id])
+    log_change("alive", chat_id)
+
+def count_dead_chats():
+    if store:
+        return store.count_dead()
+    return len(dead_chats)
+
+def record_send_result(chat_id, error):
+    if error is None:
+        send_failures.pop(chat_id, None)
+        return
+
+    reason = permanent_failure_reason(error)
+    if reason is None:
+        if is_transient_failure(error):
+            return
+        failures = send_failures.get(chat_id, 0) + 1
+        if failures < DEAD_AFTER_FAILURES:
+            send_failures[chat_id] = failures
+            return
+        reason = f"{failures} failed sends, last: {error}"
+    send_failures.pop(chat_id, None)
+    mark_dead(chat_id, reason)
 
 # Handler to set a timer for auto-delete
 async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -94,46 +593,27 @@ async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Set the timer for the group
-    group_settings[chat_id] = {"delete_timer": timer_minutes * 60, "auto_delete": True}
-    save_data()
+    update_group_config(chat_id, delete_timer=timer_minutes * 60, auto_delete=True)
 
     await update.message.reply_text(f"Auto-delete timer set to {timer_minutes} minutes for this group.")
 
-DEFAULT_AUTO_DELETE_TIME = 30 * 60  # Default timer in minutes
-
-async def handle_auto_delete(update, delete_timer):
-    """Handle auto-delete logic (simplified for demo)"""
-    await asyncio.sleep(delete_timer)
-    await update.message.delete()
-
 async def toggle_auto_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global group_settings  # Ensure global variable is used
     chat_id = update.message.chat.id
 
-    # Retrieve or initialize group config with default delete timer
-    group_config = group_settings.get(
-        chat_id,
-        {"delete_timer": DEFAULT_AUTO_DELETE_TIME, "auto_delete": True}
-    )
-
     # Check if the user provided a command argument
     if context.args:
         option = context.args[0].lower()
 
         # Handle 'on' command
         if option == 'on':
-            group_config["auto_delete"] = True
-            group_settings[chat_id] = group_config
-            save_data()
+            update_group_config(chat_id, auto_delete=True)
             auto_delete_status = "enabled"
             await update.message.reply_text(f"Auto-delete is now {auto_delete_status} for this group.")
             return
 
         # Handle 'off' command
         elif option == 'off':
-            group_config["auto_delete"] = False
-            group_settings[chat_id] = group_config
-            save_data()
+            update_group_config(chat_id, auto_delete=False)
             auto_delete_status = "disabled"
             await update.message.reply_text(f"Auto-delete is now {auto_delete_status} for this group.")
             return
@@ -146,25 +626,67 @@ async def toggle_auto_delete(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
 
+# Admin cache
+# Admin IDs per chat are kept for ADMIN_CACHE_TTL seconds in an LRU dict so
+# repeated /settimer and /auth calls don't each fetch the full admin list.
+# Concurrent lookups for the same chat share one get_chat_administrators call.
+ADMIN_CACHE_TTL = 300  # Seconds before a chat's admin list is fetched again
+ADMIN_CACHE_SIZE = 1024  # Chats kept in the admin cache
+
+admin_cache = OrderedDict()  # chat_id -> (expires_at, set of admin user IDs)
+admin_lookups = {}  # chat_id -> in-flight lookup task
+
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+async def fetch_admin_ids(chat_id, bot):
+    chat_admins = await bot.get_chat_administrators(chat_id)
+    admin_ids = {admin.user.id for admin in chat_admins}
+    admin_cache[chat_id] = (time.monotonic() + ADMIN_CACHE_TTL, admin_ids)
+    admin_cache.move_to_end(chat_id)
+    if len(admin_cache) > ADMIN_CACHE_SIZE:
+        admin_cache.popitem(last=False)  # Evict the least recently used chat
+    return admin_ids
+
+async def get_admin_ids(chat_id, bot):
+    entry = admin_cache.get(chat_id)
+    if entry and entry[0] > time.monotonic():
+        admin_cache.move_to_end(chat_id)
+        return entry[1]
+
+    lookup = admin_lookups.get(chat_id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(fetch_admin_ids(chat_id, bot))
+        admin_lookups[chat_id] = lookup
+        lookup.add_done_callback(lambda _: admin_lookups.pop(chat_id, None))
+    # Shield so one cancelled caller doesn't cancel the lookup for the others
+    return await asyncio.shield(lookup)
+
+def invalidate_admins(chat_id):
+    admin_cache.pop(chat_id, None)
+
 async def is_admin_or_owner(user_id, chat_id, bot):
     if user_id == int(OWNER_ID):
         return True
-    chat_admins = await bot.get_chat_administrators(chat_id)
-    return any(admin.user.id == user_id for admin in chat_admins)
+    return user_id in await get_admin_ids(chat_id, bot)
+
+# Drop the cached admin list when someone is promoted or demoted
+async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    if change.old_chat_member.status in ADMIN_STATUSES or change.new_chat_member.status in ADMIN_STATUSES:
+        invalidate_admins(change.chat.id)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
 
-    if user_id not in started_users:
-        started_users.add(user_id)
-        print(f"New user added: {user_id}")  # Debug line
-        save_data()  # Save the data after adding a new user
+    # A user or group that comes back is no longer dead
+    reactivate_chat(chat_id)
+
+    if note_started_user(user_id):
+        log.debug("New user added: %s", user_id, extra={"user_id": user_id})
 
-    if chat_id not in group_ids:
-        group_ids.add(chat_id)
-        print(f"New group added: {chat_id}")  # Debug line
-        save_data()  # Save the data after adding a new group
+    if add_group(chat_id):
+        log.debug("New group added: %s", chat_id, extra={"chat_id": chat_id})
 
     await update.message.reply_text(
         " 𝗛𝗲𝗹𝗹𝗼! 𝗜 𝗰𝗮𝗻 𝗵𝗲𝗹𝗽 𝗺𝗮𝗻𝗮𝗴𝗲 𝘆𝗼𝘂𝗿 𝗴𝗿𝗼𝘂𝗽 𝗯𝘆:\n \n "
@@ -206,14 +728,12 @@ async def authorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Add to global or group-specific authorization
     if user_id == int(OWNER_ID):  # Owner's authorization is global
-        global_authorized_users.add(target_user_id)
+        await collect(context.application, "authorize_global", target_user_id)
         await update.message.reply_text(f"User {target_username or target_user_id} has been globally authorized.")
     else:  # Admin's authorization is group-specific
-        group_authorized_users.setdefault(chat_id, set()).add(target_user_id)
+        authorize_in_group(chat_id, target_user_id)
         await update.message.reply_text(f"User {target_username or target_user_id} has been authorized in this group.")
 
-    save_data()
-
 async def unauthorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
@@ -239,55 +759,110 @@ async def unauthorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: Please provide a user ID with /unauth <user_id> or reply to a user's message.")
         return
 
-    # Debugging: check user ID being processed
-    print(f"Attempting to unauthorize user: {target_user_id}")
+    log.debug("Attempting to unauthorize user: %s", target_user_id, extra={"user_id": target_user_id})
 
     # Remove from global authorized list
-    if target_user_id in global_authorized_users:
-        global_authorized_users.discard(target_user_id)
+    if await collect(context.application, "unauthorize_global", target_user_id):
         await update.message.reply_text(
             f"User {target_username or target_user_id} has been globally unauthorized."
         )
     else:
         await update.message.reply_text(f"User {target_username or target_user_id} was not authorized globally.")
 
-    # Save data after modification
-    save_data()
-
 async def list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != int(OWNER_ID):
         await update.message.reply_text("Only the bot owner can use this command.")
         return
 
-    # Initialize the count of valid groups
-    valid_group_count = 0
-
-    # Loop through all group IDs
-    for group_id in group_ids:
+    # Optional filter: /listgroup <days> only counts groups active in the last N days
+    active_days = None
+    if context.args:
         try:
-            # Try to get the group chat information
-            chat = await context.bot.get_chat(group_id)
-
-            # Count the group only if its title is not None or empty
-            if chat.title:
-                valid_group_count += 1
-        except Exception as e:
-            # Skip any group where fetching details failed (no valid group)
-            continue
+            active_days = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Usage: /listgroup [active_in_last_days]")
+            return
 
-    if valid_group_count > 0:
-        await update.message.reply_text(f"The bot is added to {valid_group_count} valid groups.")
+    summary = await collect(context.application, "groups", active_days)
+    if summary["groups"] > 0:
+        period = f" active in the last {active_days} days" if active_days else ""
+        await update.message.reply_text(
+            f"The bot is added to {summary['groups']} valid groups{period}.\n"
+            f"Admin in {summary['admins']} of them, {summary['members']} members in total."
+        )
     else:
         await update.message.reply_text("The bot is not added to any valid groups.")
 
+    if summary["pending"] > 0:
+        await update.message.reply_text(f"{summary['pending']} groups have not been indexed yet.")
+
+# Answered from the group index instead of calling get_chat for each group
+def group_summary(application, active_days):
+    groups = indexed_groups(active_days)
+    return {
+        "groups": len(groups),
+        "admins": sum(1 for info in groups if info.get("bot_admin")),
+        "members": sum(info.get("members") or 0 for info in groups),
+        "pending": sum(1 for chat_id in get_group_chat_ids() if not group_index.get(chat_id, {}).get("title")),
+    }
+
 
 async def count_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != int(OWNER_ID):
         await update.message.reply_text("Only the bot owner can use this command.")
         return
 
-    total_users = len(started_users)
-    await update.message.reply_text(f"Total number of users who started the bot: {total_users}")
+    summary = await collect(context.application, "users")
+    await update.message.reply_text(
+        f"Total number of users who started the bot: {summary['users']}\n"
+        f"Groups with the bot: {summary['groups']}\n"
+        f"Unreachable users and groups skipped: {summary['dead']}"
+    )
+
+def user_summary(application):
+    return {"users": count_started_users(), "groups": len(indexed_groups()), "dead": count_dead_chats()}
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != int(OWNER_ID):
+        await update.message.reply_text("Only the bot owner can use this command.")
+        return
+
+    summary = await collect(context.application, "stats")
+    counts, worst, queued = summary["counts"], summary["worst"], summary["queued"]
+    routes = ", ".join(f"{route} {count}" for route, count in summary["routes"].items())
+    await update.message.reply_text(
+        f"Uptime: {worst['uptime'] / 3600:.1f} hours\n"
+        f"Updates: {routes or 'none'} (p99 {worst['update_p99'] * 1000:.1f} ms)\n"
+        f"Pending deletions: {counts['pending_deletions']} "
+        f"(late by p50 {worst['lateness_p50']:.1f} s, p99 {worst['lateness_p99']:.1f} s)\n"
+        f"Outbound queue: {queued[DELETE]} deletions, {queued[SEND]} sends, {queued[BULK]} broadcast sends, "
+        f"{queued[READ]} reads\n"
+        f"API calls: {counts['api_calls']}, errors: {counts['api_errors']} (p99 {worst['api_p99'] * 1000:.0f} ms)\n"
+        f"Data save: p99 {worst['save_p99'] * 1000:.0f} ms\n"
+        f"Event loop lag: p99 {worst['lag_p99'] * 1000:.0f} ms, max {worst['lag_max'] * 1000:.0f} ms"
+    )
+
+# Counts add up across shards, latencies are the worst shard's
+def stats_summary(application):
+    return {
+        "counts": {
+            "pending_deletions": len(pending_deletions),
+            "api_calls": api_seconds.count(),
+            "api_errors": sum(api_errors.values.values()),
+        },
+        "routes": {route: update_seconds.count(route) for (route,) in update_seconds.values},
+        "queued": outbound.queued(),
+        "worst": {
+            "uptime": time.monotonic() - started_at,
+            "update_p99": update_seconds.quantile(0.99),
+            "lateness_p50": deletion_lateness.quantile(0.5),
+            "lateness_p99": deletion_lateness.quantile(0.99),
+            "api_p99": api_seconds.quantile(0.99),
+            "save_p99": save_seconds.quantile(0.99),
+            "lag_p99": loop_lag.quantile(0.99),
+            "lag_max": loop_lag.max(),
+        },
+    }
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != int(OWNER_ID):
@@ -298,70 +873,98 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please reply to a message to broadcast it.")
         return
 
-    recipients = list(started_users | group_ids)
-    success_count = 0
-    failure_count = 0
+    recipients = await collect(context.application, "broadcast", update.message.chat.id,
+                               update.message.reply_to_message.message_id)
+    if recipients is None:
+        await update.message.reply_text("A broadcast is already running. Use /broadcaststatus to follow it.")
+        return
+    await update.message.reply_text(f"Broadcast started to {recipients} chats. Use /broadcaststatus to follow it.")
+
+# Returns the number of recipients, or None when a broadcast is already running
+def start_broadcast_job(application, chat_id, message_id):
+    current = application.bot_data.get("broadcast")
+    if current and not current.finished:
+        return None
+
+    job = Broadcast(
+        application.bot,
+        outbound,
+        from_chat_id=chat_id,
+        message_id=message_id,
+        recipients=get_recipients(),
+        report_chat_id=chat_id,
+        on_result=record_send_result,
+    )
+    job.save_job()
+    start_broadcast(application, job)
+    return len(job.recipients)
+
+# Run a broadcast in the background and report to the owner when it's done
+def start_broadcast(application, job):
+    application.bot_data["broadcast"] = job
+    # A plain task, so Application.stop() doesn't wait hours for the broadcast to finish
+    application.bot_data["broadcast_task"] = asyncio.create_task(run_broadcast(job))
 
+async def run_broadcast(job):
     try:
-        # Check the type of the message to be broadcasted
-        if update.message.reply_to_message.sticker:
-            media = update.message.reply_to_message.sticker.file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_sticker(chat_id=recipient, sticker=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.photo:
-            media = update.message.reply_to_message.photo[-1].file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_photo(chat_id=recipient, photo=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.video:
-            media = update.message.reply_to_message.video.file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_video(chat_id=recipient, video=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.document:
-            media = update.message.reply_to_message.document.file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_document(chat_id=recipient, document=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.text:
-            media = update.message.reply_to_message.text
-            for recipient in recipients:
-                try:
-                    await context.bot.send_message(chat_id=recipient, text=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        else:
-            await update.message.reply_text("Unsupported media type for broadcasting.")
-            return
+        await job.run()
+    except Exception as e:
+        await job.bot.send_message(chat_id=job.report_chat_id, text=f"An error occurred during broadcast: {e}")
+        return
+    if not job.finished:  # Stopped for shutdown, the next start resumes it from the checkpoint
+        return
 
-        # Send broadcast completion summary
-        await update.message.reply_text(
-            f"Broadcast completed.\n\n"
-            f"✅ Successfully sent to: {success_count}\n"
-            f"❌ Failed to send to: {failure_count}"
-        )
+    # Send broadcast completion summary, each shard reports its own part
+    shard = f" on shard {SHARD_ID + 1} of {SHARD_COUNT}" if SHARD_ID is not None else ""
+    await job.bot.send_message(
+        chat_id=job.report_chat_id,
+        text=f"Broadcast completed{shard}.\n\n"
+        f"✅ Successfully sent to: {job.sent}\n"
+        f"❌ Failed to send to: {job.failed}"
+    )
 
-    except Exception as e:
-        await update.message.reply_text(f"An error occurred during broadcast: {e}")
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != int(OWNER_ID):
+        await update.message.reply_text("Only the bot owner can use this command.")
+        return
+
+    summary = await collect(context.application, "broadcast_status")
+    if not summary:
+        await update.message.reply_text("No broadcast has run since the bot started.")
+        return
+
+    stats = summary["stats"]
+    eta = f"{stats['eta'] / 60:.1f} minutes" if stats["eta"] is not None else "unknown"
+    state = "completed" if summary["finished"] else "running"
+    await update.message.reply_text(
+        f"Broadcast {state}.\n\n"
+        f"✅ Sent: {stats['sent']}\n"
+        f"❌ Failed: {stats['failed']}\n"
+        f"⏳ Remaining: {stats['remaining']} of {stats['total']}\n"
+        f"Speed: {stats['rate']:.1f} messages/second\n"
+        f"ETA: {eta}"
+    )
+
+def broadcast_summary(application):
+    job = application.bot_data.get("broadcast")
+    if not job:
+        return None
+    return {"stats": job.stats(), "finished": job.finished}
+
+async def resume_broadcast(application):
+    if WORKER_ID:  # Broadcasts run on worker 0, which gets every owner command
+        return
+    job = Broadcast.load(application.bot, outbound, on_result=record_send_result)
+    if job:
+        log.info("Resuming broadcast at %d of %d recipients.", job.sent + job.failed, len(job.recipients))
+        start_broadcast(application, job)
+
+async def stop_broadcast(application):
+    job = application.bot_data.get("broadcast")
+    if job:
+        job.stop()
+    # Broadcast.run() saves its progress when it returns or is cancelled
+    await finish_task(application.bot_data.pop("broadcast_task", None), drain_time_left(application))
 
 
 async def handle_edited_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -369,63 +972,364 @@ async def handle_edited_message(update: Update, context: ContextTypes.DEFAULT_TY
     chat_id = update.edited_message.chat.id
     user_id = user.id
 
-    # Skip globally authorized users
-    if user_id in global_authorized_users:
+    # Skip globally authorized users and group-specific authorized users for this chat
+    if is_exempt(chat_id, user_id):
         return
 
-    # Skip group-specific authorized users for this chat
-    if chat_id in group_authorized_users and user_id in group_authorized_users[chat_id]:
+    # Due now, so the deletion loop sends it with the other edits in this chat in one batch
+    schedule_deletion(chat_id, update.edited_message.message_id, 0)
+    note_edit(context.bot, chat_id, user)
+
+# Edit announcements
+# Edits in a chat are gathered for EDIT_ANNOUNCE_WINDOW seconds and announced
+# in one message that names every editor and their count, instead of one
+# message per edit.
+EDIT_ANNOUNCE_WINDOW = 3  # Seconds of edits gathered into one announcement
+EDIT_ANNOUNCE_MAX_USERS = 10  # Editors named in one announcement, the rest are counted
+
+pending_edits = {}  # chat_id -> {"users": {user_id: [mention, edits]}, "timer": TimerHandle}
+
+def note_edit(bot, chat_id, user):
+    entry = pending_edits.get(chat_id)
+    if entry is None:
+        timer = asyncio.get_running_loop().call_later(EDIT_ANNOUNCE_WINDOW, announce_edits, bot, chat_id)
+        entry = pending_edits[chat_id] = {"users": {}, "timer": timer}
+    editor = entry["users"].get(user.id)
+    if editor is None:
+        entry["users"][user.id] = [user.mention_html(), 1]
+    else:
+        editor[1] += 1
+
+def edit_announcement(users):
+    editors = list(users.values())
+    if len(editors) == 1 and editors[0][1] == 1:
+        return f" 𝘙𝘰𝘴𝘦𝘴 𝘢𝘳𝘦 𝘳𝘦𝘥, 𝘷𝘪𝘰𝘭𝘦𝘵𝘴 𝘢𝘳𝘦 𝘣𝘭𝘶𝘦, {editors[0][0]} 𝘦𝘥𝘪𝘵𝘦𝘥 𝘢 𝘮𝘦𝘴𝘴𝘢𝘨𝘦, 𝘯𝘰𝘸 𝘪𝘵'𝘴 𝘨𝘰𝘯𝘦 𝘛𝘰𝘰!😮‍💨"
+
+    names = [mention if edits == 1 else f"{mention} ({edits})" for mention, edits in editors[:EDIT_ANNOUNCE_MAX_USERS]]
+    if len(editors) > EDIT_ANNOUNCE_MAX_USERS:
+        names.append(f"{len(editors) - EDIT_ANNOUNCE_MAX_USERS} 𝘮𝘰𝘳𝘦")
+    total = sum(edits for _, edits in editors)
+    return f" 𝘙𝘰𝘴𝘦𝘴 𝘢𝘳𝘦 𝘳𝘦𝘥, 𝘷𝘪𝘰𝘭𝘦𝘵𝘴 𝘢𝘳𝘦 𝘣𝘭𝘶𝘦, {', '.join(names)} 𝘦𝘥𝘪𝘵𝘦𝘥 {total} 𝘮𝘦𝘴𝘴𝘢𝘨𝘦𝘴, 𝘯𝘰𝘸 𝘵𝘩𝘦𝘺'𝘳𝘦 𝘨𝘰𝘯𝘦 𝘛𝘰𝘰!😮‍💨"
+
+def announce_edits(bot, chat_id):
+    entry = pending_edits.pop(chat_id, None)
+    if entry is None:
+        return
+    announcement = edit_announcement(entry["users"])
+    queue_call(chat_id, SEND, lambda: bot.send_message(chat_id=chat_id, text=announcement, parse_mode="HTML"),
+               "announce edited messages")
+
+# Send what has been gathered so far instead of dropping it, used on shutdown
+def flush_edit_announcements(bot):
+    for chat_id in list(pending_edits):
+        pending_edits[chat_id]["timer"].cancel()
+        announce_edits(bot, chat_id)
+
+
+def handle_new_message(chat_id, message_id, group_config):
+    # Check if auto-delete is enabled
+    if group_config.auto_delete:
+        # Queue the message in the deletion scheduler
+        schedule_deletion(chat_id, message_id, group_config.delete_timer)
+    else:
+        log.debug("Auto-delete is disabled for this group.", extra={"chat_id": chat_id, "message_id": message_id})
+
+# Update routing
+# One handler sees every message and edit, classifies it once and sends it
+# down a single path, so adding features doesn't add filter passes per update.
+# Commands are only tracked here; their CommandHandlers run in the next group.
+ROUTE_GROUP = -1  # Handler group for route_update, runs before the command handlers
+
+# Keep in sync with the CommandHandlers in build_application()
+BOT_COMMANDS = {"start", "auth", "unauth", "listgroup", "countuser", "broadcast", "broadcaststatus",
+                "settimer", "autodlt", "stats"}
+
+def is_bot_command(message, bot_username):
+    entities = message.entities
+    if not entities or entities[0].type != "bot_command" or entities[0].offset != 0:
+        return False
+    command, _, target = message.text[1:entities[0].length].lower().partition("@")
+    return command in BOT_COMMANDS and (not target or target == (bot_username or "").lower())
+
+def classify_update(update, bot_username):
+    if update.edited_message:
+        return "edited", update.edited_message
+    message = update.message
+    if message is None:
+        return None, None  # Channel posts and other update types are not handled
+    if message.new_chat_members:
+        return "new_members", message
+    if is_bot_command(message, bot_username):
+        return "command", message
+    return "new", message
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    started = time.perf_counter()
+    route, message = classify_update(update, context.bot.username)
+    if route is None:
         return
 
     try:
-        username = user.mention_html()
-        announcement = f" 𝘙𝘰𝘴𝘦𝘴 𝘢𝘳𝘦 𝘳𝘦𝘥, 𝘷𝘪𝘰𝘭𝘦𝘵𝘴 𝘢𝘳𝘦 𝘣𝘭𝘶𝘦, {username} 𝘦𝘥𝘪𝘵𝘦𝘥 𝘢 𝘮𝘦𝘴𝘴𝘢𝘨𝘦, 𝘯𝘰𝘸 𝘪𝘵'𝘴 𝘨𝘰𝘯𝘦 𝘛𝘰𝘰!😮‍💨"
+        chat = message.chat
+        chat_id = chat.id
+
+        # Tracking: any traffic brings a dead chat back and refreshes the group index
+        reactivate_chat(chat_id)
+        if chat_id < 0:
+            note_group_activity(chat)
+
+        if route == "new":
+            handle_new_message(chat_id, message.message_id, get_group_config(chat_id))
+        elif route == "edited":
+            await handle_edited_message(update, context)
+        elif route == "new_members":
+            await new_chat_member(update, context)
+    except Exception:
+        log.exception("Error handling %s update", route,
+                      extra={"route": route, "chat_id": message.chat_id, "message_id": message.message_id})
+    finally:
+        update_seconds.observe(time.perf_counter() - started, route)
+
+# Deletion scheduler
+# Pending deletions live in one min-heap served by a single timer loop, instead
+# of one sleeping task per message. Each entry packs (due_ts, chat_id, message_id)
+# into one int, due time in the high bits so ints sort by due time. That is about
+# 48 bytes per pending deletion against 160 for a tuple of three objects.
+# The heap is written to DELETIONS_FILE so pending deletions survive a restart.
+DELETIONS_FILE = shard_file("pending_deletions.json")
+DELETIONS_SAVE_INTERVAL = 30  # Seconds between saves of the pending deletions
+DELETION_BATCH_WINDOW = 1.0  # Seconds to wait so deletions due close together share one call
+DELETION_BATCH_SIZE = 100  # Maximum message IDs per deleteMessages call
+DELETION_RETRY_DELAY = 5  # Seconds before retrying a batch that failed with a network error
+DELETION_PASS_LIMIT = 20 * DELETION_BATCH_SIZE  # Due messages taken per pass, so a backlog goes out in steady passes
+
+DUE_TICKS = 10  # Due times are kept in tenths of a second
+CHAT_ID_OFFSET = 1 << 52  # Chat IDs have at most 52 significant bits, the offset makes them positive
+MESSAGE_ID_BITS = 32
+CHAT_ID_BITS = 53
+
+pending_deletions = []  # Min-heap of packed (due_ts, chat_id, message_id)
+deletions_dirty = False  # True when the heap changed since the last save
+deletions_save = None  # Future of the save running in a worker thread
+deletion_wakeup = None  # asyncio.Event set when an earlier deletion is queued
+deletion_stopping = False  # Set on shutdown, the loop returns after the pass it is sending
+deletion_metrics = {
+    "batches": 0,  # deleteMessages calls made
+    "messages": 0,  # Message IDs sent in successful batches
+    "failed": 0,  # Message IDs dropped because Telegram refused to delete them
+    "retried": 0,  # Message IDs put back on the heap after a transient error
+    "last_batch_size": 0,
+    "last_batch_seconds": 0.0,
+}
+
+def pack_deletion(due_ts, chat_id, message_id):
+    return ((round(due_ts * DUE_TICKS) << (CHAT_ID_BITS + MESSAGE_ID_BITS))
+            | ((chat_id + CHAT_ID_OFFSET) << MESSAGE_ID_BITS) | message_id)
+
+def unpack_deletion(entry):
+    return (
+        (entry >> (CHAT_ID_BITS + MESSAGE_ID_BITS)) / DUE_TICKS,
+        ((entry >> MESSAGE_ID_BITS) & ((1 << CHAT_ID_BITS) - 1)) - CHAT_ID_OFFSET,
+        entry & ((1 << MESSAGE_ID_BITS) - 1),
+    )
 
-        # Send announcement about edited message
-        await context.bot.send_message(chat_id=chat_id, text=announcement, parse_mode="HTML")
+def deletion_due(entry):
+    return (entry >> (CHAT_ID_BITS + MESSAGE_ID_BITS)) / DUE_TICKS
 
-        # Delete the edited message
-        await update.edited_message.delete()
-    except Exception as e:
-        print(f"Failed to delete edited message: {e}")
+def read_deletions(path):
+    with open(path, "r") as f:
+        entries = json.load(f)
+    # Older files hold [due_ts, chat_id, message_id] lists
+    return [entry if isinstance(entry, int) else pack_deletion(*entry) for entry in entries]
 
-
-async def handle_new_message(update, context):
+def load_deletions():
+    global pending_deletions
     try:
-        # Extract chat ID and message ID safely
-        if update.effective_chat and update.message:
-            chat_id = update.effective_chat.id
-            message_id = update.message.message_id
-        else:
-            print("Error: update.effective_chat or update.message is None.")
-            return  # Exit early if data is missing
-
-        # Get group settings or use defaults
-        group_config = group_settings.get(chat_id, {"delete_timer": DEFAULT_AUTO_DELETE_TIME, "auto_delete": True})
-
-
-        # Check if auto-delete is enabled
-        if group_config.get("auto_delete"):
-            delete_timer = group_config.get("delete_timer", DEFAULT_AUTO_DELETE_TIME)
-
-            # Schedule the message deletion task
-            asyncio.create_task(delete_message(context, chat_id, message_id, delete_timer))
-        else:
-            print("Auto-delete is disabled for this group.")
-
+        pending_deletions = read_deletions(DELETIONS_FILE)
+    except FileNotFoundError:
+        pending_deletions = []
+    except (json.JSONDecodeError, TypeError) as e:
+        log.error("Error loading %s: %s", DELETIONS_FILE, e)
+        pending_deletions = []
+    heapq.heapify(pending_deletions)
+
+def save_deletions():
+    global deletions_dirty
+    write_json(DELETIONS_FILE, pending_deletions)
+    deletions_dirty = False
+
+# Writes a copy of the heap from a worker thread, so a large heap doesn't stall the event loop
+async def save_deletions_in_background():
+    global deletions_dirty, deletions_save
+    deletions_dirty = False
+    deletions_save = asyncio.get_running_loop().run_in_executor(None, write_json, DELETIONS_FILE,
+                                                                pending_deletions[:])
+    try:
+        # Shielded so a cancelled loop doesn't leave the write running unseen, shutdown waits for it
+        await asyncio.shield(deletions_save)
     except Exception as e:
-        print(f"Error in handle_new_message: {e}")
-async def delete_message(context, chat_id, message_id, delete_timer):
+        log.error("Error writing %s, retrying: %s", DELETIONS_FILE, e)
+        deletions_dirty = True
+
+def schedule_deletion(chat_id, message_id, delete_timer):
+    global deletions_dirty
+    entry = pack_deletion(time.time() + delete_timer, chat_id, message_id)
+    heapq.heappush(pending_deletions, entry)
+    deletions_dirty = True
+
+    # Wake the loop only if this deletion is now the earliest one
+    if deletion_wakeup is not None and pending_deletions[0] == entry:
+        deletion_wakeup.set()
+
+def pop_due_deletions(now, limit=DELETION_PASS_LIMIT):
+    # Group due message IDs by chat so each chat gets as few calls as possible.
+    # The heap hands them out oldest first, so a catch-up backlog is sent in that order.
+    due = {}
+    while pending_deletions and deletion_due(pending_deletions[0]) <= now and limit > 0:
+        limit -= 1
+        due_ts, chat_id, message_id = unpack_deletion(heapq.heappop(pending_deletions))
+        deletion_lateness.observe(now - due_ts)
+        due.setdefault(chat_id, {})[message_id] = None  # A message edited twice is only deleted once
+    return {chat_id: list(message_ids) for chat_id, message_ids in due.items()}
+
+def requeue_deletions(chat_id, message_ids, delay):
+    global deletions_dirty
+    due_ts = time.time() + delay
+    for message_id in message_ids:
+        heapq.heappush(pending_deletions, pack_deletion(due_ts, chat_id, message_id))
+    deletions_dirty = True
+    deletion_metrics["retried"] += len(message_ids)
+
+# Errors that fail every deletion in the chat, splitting the batch can't help
+CHAT_WIDE_DELETE_ERRORS = ("not enough rights", "need administrator rights", "chat_admin_required")
+# Errors that are always about single messages, e.g. ones the sender already deleted
+PER_MESSAGE_DELETE_ERRORS = ("message to delete not found",)
+
+def drop_deletions(chat_id, message_ids, error):
+    deletion_metrics["failed"] += len(message_ids)
+    log.warning("Error deleting %d messages in chat %s: %s", len(message_ids), chat_id, error,
+                extra={"chat_id": chat_id, "message_ids": message_ids})
+
+# Returns the error message when every message in the batch failed with the same
+# BadRequest. With split=False a BadRequest is only returned, not handled.
+async def delete_batch(bot, chat_id, message_ids, split=True):
+    started = time.monotonic()
     try:
-
-        await asyncio.sleep(delete_timer)  # Wait before deleting
-
-        # Attempt to delete the message
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-
-
+        # Without retry the queue hands RetryAfter back, and the heap holds the batch instead
+        await outbound.submit(chat_id, DELETE, lambda: bot.delete_messages(chat_id=chat_id, message_ids=message_ids),
+                              retry=False)
+    except RetryAfter as e:
+        requeue_deletions(chat_id, message_ids, e.retry_after)
+        return
+    except BadRequest as e:
+        if not split:
+            return e.message
+        description = e.message.lower()
+        if len(message_ids) == 1 or any(text in description for text in CHAT_WIDE_DELETE_ERRORS):
+            drop_deletions(chat_id, message_ids, e)
+            return e.message
+        # One bad ID fails the whole call, so split the batch to isolate it
+        middle = len(message_ids) // 2
+        first, second = message_ids[:middle], message_ids[middle:]
+        if (await delete_batch(bot, chat_id, first) == e.message
+                and not any(text in description for text in PER_MESSAGE_DELETE_ERRORS)):
+            # Every message in the first half failed. If the second half fails the same
+            # way in one call, the error is about the chat and splitting it is pointless.
+            second_error = await delete_batch(bot, chat_id, second, split=False)
+            if second_error == e.message:
+                drop_deletions(chat_id, second, e)
+                return e.message
+            if second_error is None:
+                return
+        await delete_batch(bot, chat_id, second)
+        return
+    except Forbidden as e:
+        # The bot was removed from the chat, none of these can be deleted
+        drop_deletions(chat_id, message_ids, e)
+        record_send_result(chat_id, e)
+        return
     except Exception as e:
-        print(f"Error deleting message {message_id} in chat {chat_id}: {e}")
+        log.warning("Error deleting %d messages in chat %s, retrying: %s", len(message_ids), chat_id, e,
+                    extra={"chat_id": chat_id, "message_ids": message_ids})
+        requeue_deletions(chat_id, message_ids, DELETION_RETRY_DELAY)
+        return
+
+    deletion_metrics["batches"] += 1
+    deletion_metrics["messages"] += len(message_ids)
+    deletion_metrics["last_batch_size"] = len(message_ids)
+    deletion_metrics["last_batch_seconds"] = time.monotonic() - started
+
+async def delete_due_messages(bot, due):
+    batches_before = deletion_metrics["batches"]
+    messages_before = deletion_metrics["messages"]
+    batches = [
+        (chat_id, message_ids[i:i + DELETION_BATCH_SIZE])
+        for chat_id, message_ids in due.items()
+        for i in range(0, len(message_ids), DELETION_BATCH_SIZE)
+    ]
+    # All batches are queued at once, the outbound queue takes turns between chats
+    tasks = [asyncio.create_task(delete_batch(bot, chat_id, message_ids)) for chat_id, message_ids in batches]
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        # Cut off by shutdown: put back what hasn't settled so it is saved with the heap
+        for (chat_id, message_ids), task in zip(batches, tasks):
+            if not task.done() or task.cancelled():
+                requeue_deletions(chat_id, message_ids, 0)
+        raise
+
+    log.info("Deleted %d messages in %d batches across %d chats.", deletion_metrics["messages"] - messages_before,
+             deletion_metrics["batches"] - batches_before, len(due))
+
+async def deletion_loop(bot):
+    global deletion_wakeup, deletions_dirty
+    deletion_wakeup = asyncio.Event()
+    last_save = time.monotonic()
+
+    while not deletion_stopping:
+        now = time.time()
+        due = pop_due_deletions(now)
+        if due:
+            deletions_dirty = True
+            await delete_due_messages(bot, due)
+
+        if deletions_dirty and time.monotonic() - last_save >= DELETIONS_SAVE_INTERVAL:
+            await save_deletions_in_background()
+            last_save = time.monotonic()
+
+        # Sleep until the next deletion is due, a new earlier one arrives or the next save.
+        # Waking one batch window late lets deletions due right after it join the same call.
+        timeout = DELETIONS_SAVE_INTERVAL
+        if pending_deletions:
+            next_due = deletion_due(pending_deletions[0]) + DELETION_BATCH_WINDOW
+            timeout = min(timeout, max(next_due - time.time(), 0))
+        deletion_wakeup.clear()
+        try:
+            await asyncio.wait_for(deletion_wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def start_deletion_scheduler(application):
+    load_deletions()
+    now = time.time()
+    overdue = sum(1 for entry in pending_deletions if deletion_due(entry) <= now)
+    log.info("Loaded %d pending deletions, %d came due while the bot was down.", len(pending_deletions), overdue)
+    application.bot_data["deletion_task"] = asyncio.create_task(deletion_loop(application.bot))
+
+async def stop_deletion_scheduler(application):
+    global deletion_stopping, deletions_dirty
+    task = application.bot_data.pop("deletion_task", None)
+    deletion_stopping = True
+    if deletion_wakeup is not None:
+        deletion_wakeup.set()
+    await finish_task(task, drain_time_left(application))
+    deletion_stopping = False
+    if deletions_save is not None:
+        await asyncio.wait({deletions_save})  # Two writes to the same temporary file would collide
+        if deletions_save.exception():  # Also covers a save the loop was cancelled out of
+            deletions_dirty = True
+    if deletions_dirty:
+        save_deletions()
 
 
 
@@ -452,8 +1356,7 @@ async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Set the timer for the group
-    group_settings[chat_id] = {"delete_timer": timer_minutes * 60, "auto_delete": True}
-    save_data()
+    update_group_config(chat_id, delete_timer=timer_minutes * 60, auto_delete=True)
 
     await update.message.reply_text(f"Auto-delete timer set to {timer_minutes} minutes for this group.")
 
@@ -461,13 +1364,316 @@ async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def new_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     if chat.type in ['group', 'supergroup']:
-        try:
-            await context.bot.send_message(chat_id=chat.id, text=" 𝗛𝗲𝘆! 𝗧𝗵𝗮𝗻𝗸𝘀 𝗙𝗼𝗿 𝗮𝗱𝗱𝗶𝗻𝗴 𝗺𝗲 𝘁𝗼 𝘆𝗼𝘂𝗿 𝗴𝗿𝗼𝘂𝗽 𝗰𝗹𝗶𝗰𝗸 - /start 𝗧𝗼 𝗲𝗻𝗮𝗯𝗹𝗲 𝗺𝘆 𝗳𝘂𝗻𝗰𝘁𝗶𝗼𝗻𝘀 🙃 ")
-        except Forbidden:
-            print(f"Cannot send message to chat {chat.id}. The bot might have been removed or lacks permissions.")
+        queue_call(chat.id, SEND, lambda: context.bot.send_message(chat_id=chat.id, text=" 𝗛𝗲𝘆! 𝗧𝗵𝗮𝗻𝗸𝘀 𝗙𝗼𝗿 𝗮𝗱𝗱𝗶𝗻𝗴 𝗺𝗲 𝘁𝗼 𝘆𝗼𝘂𝗿 𝗴𝗿𝗼𝘂𝗽 𝗰𝗹𝗶𝗰𝗸 - /start 𝗧𝗼 𝗲𝗻𝗮𝗯𝗹𝗲 𝗺𝘆 𝗳𝘂𝗻𝗰𝘁𝗶𝗼𝗻𝘀 🙃 "),
+                   "send welcome message")
+
+# Group index
+# Title, type, member count, last activity and the bot's admin status for every
+# group, so /listgroup and /countuser never call the Bot API. Entries are
+# updated from incoming messages and my_chat_member updates for free, and a
+# background refresher re-fetches stale entries a few groups at a time.
+GROUP_INDEX_FILE = shard_file("group_index.json")
+GROUP_REFRESH_INTERVAL = 24 * 60 * 60  # Seconds before an entry is fetched again
+GROUP_REFRESH_CHECK = 10 * 60  # Seconds between refresher passes
+GROUP_REFRESH_CONCURRENCY = 5  # Groups fetched at the same time
+GROUP_REFRESH_STARTUP_DELAY = 60  # Seconds after startup before the first pass, so a restart doesn't open with it
+
+group_index = {}  # chat_id -> {"title", "type", "members", "last_active", "bot_admin", "refreshed"}
+
+def load_group_index():
+    global group_index
+    try:
+        with open(GROUP_INDEX_FILE, "r") as f:
+            group_index = {int(k): v for k, v in json.load(f).items()}
+    except FileNotFoundError:
+        group_index = {}
+    except json.JSONDecodeError as e:
+        log.error("Error loading %s: %s", GROUP_INDEX_FILE, e)
+        group_index = {}
+
+def save_group_index():
+    write_json(GROUP_INDEX_FILE, group_index)
+
+# Only groups the bot is still in, the index also sees traffic from groups it never recorded
+def indexed_groups(active_days=None):
+    tracked = set(get_group_chat_ids())
+    groups = [info for chat_id, info in group_index.items() if chat_id in tracked and info.get("title")]
+    if active_days:
+        since = time.time() - active_days * 24 * 60 * 60
+        groups = [info for info in groups if (info.get("last_active") or 0) >= since]
+    return groups
+
+# Called for every group message, so it only touches the dict
+def note_group_activity(chat):
+    info = group_index.get(chat.id)
+    if info is None:
+        info = group_index[chat.id] = {"members": None, "bot_admin": None, "refreshed": 0}
+    info["title"] = chat.title
+    info["type"] = chat.type
+    info["last_active"] = time.time()
+
+# The reads share the outbound queue's rate limit, behind everything users wait for
+async def refresh_group(bot, chat_id):
+    try:
+        chat = await outbound.submit(chat_id, READ, lambda: bot.get_chat(chat_id))
+        members = await outbound.submit(chat_id, READ, lambda: bot.get_chat_member_count(chat_id))
+        bot_member = await outbound.submit(chat_id, READ, lambda: bot.get_chat_member(chat_id, bot.id))
+    except Exception as e:
+        # A full queue or a network error says nothing about the chat, it is retried on the next pass
+        if isinstance(e, TelegramError) and not is_transient_failure(e):
+            record_send_result(chat_id, e)
+        return
+    record_send_result(chat_id, None)
+
+    info = group_index.setdefault(chat_id, {"last_active": None})
+    info["title"] = chat.title
+    info["type"] = chat.type
+    info["members"] = members
+    info["bot_admin"] = bot_member.status in ADMIN_STATUSES
+    info["refreshed"] = time.time()
+
+async def group_refresher(bot):
+    semaphore = asyncio.Semaphore(GROUP_REFRESH_CONCURRENCY)
+
+    async def refresh(chat_id):
+        async with semaphore:
+            await refresh_group(bot, chat_id)
+
+    await asyncio.sleep(GROUP_REFRESH_STARTUP_DELAY)
+    while True:
+        if WORKER_ID is not None:
+            fold_group_activity(read_worker_reports())
+        chat_ids = get_group_chat_ids()
+        for chat_id in group_index.keys() - set(chat_ids):
+            del group_index[chat_id]  # Dead or never recorded
+        stale_before = time.time() - GROUP_REFRESH_INTERVAL
+        stale = [
+            chat_id for chat_id in chat_ids
+            if group_index.get(chat_id, {}).get("refreshed", 0) < stale_before
+        ]
+        if stale:
+            await asyncio.gather(*(refresh(chat_id) for chat_id in stale))
+            log.info("Refreshed %d groups in the group index.", len(stale))
+        save_group_index()
+        await asyncio.sleep(GROUP_REFRESH_CHECK)
+
+# Keep the index and recipient lists in sync when the bot is added, promoted or removed
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.my_chat_member
+    chat = change.chat
+    status = change.new_chat_member.status
+
+    if status in (ChatMember.LEFT, ChatMember.BANNED):
+        mark_dead(chat.id, f"bot status changed to {status}")
+        return
 
-def main():
-    application = ApplicationBuilder().token("7738387262:AAFlJILd8J2BupXtBGBhSOYpKr3Uf5diP-s").build()
+    reactivate_chat(chat.id)
+    if chat.type == "private":
+        add_started_user(chat.id)
+        return
+
+    add_group(chat.id)
+    note_group_activity(chat)
+    group_index[chat.id]["bot_admin"] = status in ADMIN_STATUSES
+
+# With workers only worker 0 keeps the index, the others report their group activity to it
+async def start_group_index(application):
+    if WORKER_ID:
+        return
+    load_group_index()
+    application.bot_data["group_refresher"] = asyncio.create_task(group_refresher(application.bot))
+
+async def stop_group_index(application):
+    if WORKER_ID:
+        return
+    await cancel_task(application.bot_data.pop("group_refresher", None))
+    save_group_index()
+
+# Times every Bot API call and counts the ones that fail, by method
+class InstrumentedRequest(HTTPXRequest):
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            api_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, method)
+
+async def start_metrics(application):
+    application.bot_data["loop_lag_task"] = asyncio.create_task(monitor_loop_lag(loop_lag))
+    if METRICS_PORT:
+        server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
+        await server.start()
+        application.bot_data["metrics_server"] = server
+        log.info("Metrics on http://%s:%s/metrics", METRICS_LISTEN, server.port)
+
+async def stop_metrics(application):
+    await cancel_task(application.bot_data.pop("loop_lag_task", None))
+    server = application.bot_data.pop("metrics_server", None)
+    if server:
+        await server.stop()
+
+# Outbound queue
+# Announcements, welcome messages, deletions and broadcast sends are paced by
+# one OutboundQueue, see outbound_queue.py. Command replies go out directly.
+outbound = OutboundQueue(OUTBOUND_RATE / SHARD_COUNT)  # Shards split the global limit between them
+
+# Queue a call nobody waits for and log it if it fails
+def queue_call(chat_id, priority, call, action):
+    def done(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error:
+            log.warning("Failed to %s in chat %s: %s", action, chat_id, error, extra={"chat_id": chat_id})
+            if isinstance(error, TelegramError):  # Not the queue's own back-pressure
+                record_send_result(chat_id, error)
+    outbound.enqueue(chat_id, priority, call).add_done_callback(done)
+
+async def start_outbound(application):
+    outbound.start()
+
+async def stop_outbound(application):
+    drained = await outbound.drain(drain_time_left(application))
+    if not drained:
+        log.warning("Dropping %d outbound requests still queued at shutdown.", sum(outbound.queued()))
+    await outbound.stop()
+
+# Worker reports
+# With WEBHOOK_WORKERS above 1 every worker but worker 0 writes its /stats
+# numbers and the group activity it saw to a file every WORKER_REPORT_INTERVAL
+# seconds. Worker 0, which answers the owner commands and keeps the group
+# index, adds them in.
+WORKER_REPORT_FILE = "worker_report.json"  # worker_report.2.json is written by worker 2
+WORKER_REPORT_INTERVAL = 10  # Seconds between reports
+
+def write_worker_report(application):
+    write_json(shard_file(WORKER_REPORT_FILE, WORKER_ID), {
+        "stats": stats_summary(application),
+        "groups": {chat_id: {"title": info.get("title"), "type": info.get("type"),
+                             "last_active": info.get("last_active")}
+                   for chat_id, info in group_index.items()},
+    })
+
+async def report_to_worker_zero(application):
+    while True:
+        await asyncio.sleep(WORKER_REPORT_INTERVAL)
+        write_worker_report(application)
+
+async def start_worker_report(application):
+    if WORKER_ID:
+        application.bot_data["worker_report"] = asyncio.create_task(report_to_worker_zero(application))
+
+async def stop_worker_report(application):
+    if WORKER_ID:
+        await cancel_task(application.bot_data.pop("worker_report", None))
+        write_worker_report(application)
+
+# The latest report of every other worker, read by worker 0
+def read_worker_reports():
+    reports = []
+    for worker_id in range(1, WEBHOOK_WORKERS):
+        try:
+            with open(shard_file(WORKER_REPORT_FILE, worker_id), "r") as f:
+                reports.append(json.load(f))
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            log.error("Error loading the report of worker %d: %s", worker_id, e)
+    return reports
+
+def fold_group_activity(reports):
+    for report in reports:
+        for chat_id, reported in report["groups"].items():
+            info = group_index.setdefault(int(chat_id), {"members": None, "bot_admin": None, "refreshed": 0})
+            if (reported["last_active"] or 0) > (info.get("last_active") or 0):
+                info.update(reported)
+
+# Lifecycle
+# Shutdown runs once intake has stopped: the webhook server or poller is shut
+# and Application.stop() has finished the updates already received. Queued work
+# then gets SHUTDOWN_DRAIN_TIMEOUT seconds to finish instead of being dropped:
+# gathered edit announcements go out, the broadcast stops after its in-flight
+# sends, the deletion loop finishes the pass it is sending and the outbound
+# queue empties. Anything still unfinished is checkpointed or put back on the
+# deletion heap, and the state files are written last. On startup deletions
+# that came due while the bot was down are caught up oldest first, one pass of
+# DELETION_PASS_LIMIT at a time, through the outbound queue.
+SHUTDOWN_DRAIN_TIMEOUT = 10  # Seconds shutdown waits for queued work
+
+def drain_time_left(application):
+    return max(application.bot_data.get("drain_deadline", 0) - time.monotonic(), 0)
+
+# Startup phases in order, each one is timed into startup_seconds
+STARTUP_PHASES = (
+    ("state", start_state),
+    ("metrics", start_metrics),
+    ("wal_writer", start_wal_writer),
+    ("outbound", start_outbound),
+    ("deletions", start_deletion_scheduler),
+    ("broadcast", resume_broadcast),
+    ("group_index", start_group_index),
+    ("worker_report", start_worker_report),
+)
+startup_seconds = {}  # Phase name -> seconds the last startup spent in it
+
+async def on_startup(application):
+    for name, start_phase in STARTUP_PHASES:
+        started = time.perf_counter()
+        await start_phase(application)
+        startup_seconds[name] = time.perf_counter() - started
+    log.info("Started in %.3fs.", sum(startup_seconds.values()),
+             extra={"phases": {name: round(seconds, 4) for name, seconds in startup_seconds.items()}})
+
+async def on_shutdown(application):
+    application.bot_data["drain_deadline"] = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    flush_edit_announcements(application.bot)
+    await stop_group_index(application)
+    await stop_broadcast(application)
+    await stop_deletion_scheduler(application)
+    await stop_outbound(application)
+    await stop_worker_report(application)
+    await stop_wal_writer(application)
+    await stop_metrics(application)
+
+# Webhook mode
+# BOT_MODE=webhook receives updates over HTTP instead of long polling. With
+# WEBHOOK_WORKERS above 1 the webhook process only accepts updates and puts
+# them on one shared queue, and that many bot processes take updates from it.
+# Workers share state through SQLite, so that mode needs STORAGE_BACKEND=sqlite,
+# and before each update a worker picks up what the others committed.
+# Owner commands all go to worker 0 on a queue of its own, so the broadcast,
+# the group index and its refresher only run there. The other workers report
+# their /stats numbers and group activity to it through WORKER_REPORT_FILE.
+# Pending deletions stay in a file per worker, and when the number of workers
+# changes they are dealt out again to the files of the workers starting.
+# Telegram only calls HTTPS webhooks, so the server listens locally behind a
+# TLS proxy by default, and it refuses to start without WEBHOOK_SECRET.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public base URL given to setWebhook, e.g. https://example.com
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # Required, checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "1"))
+WEBHOOK_SHARDS = int(os.environ.get("WEBHOOK_SHARDS", "1"))  # Shard processes, see serve_sharded()
+WEBHOOK_QUEUE_SIZE = 10000  # Updates waiting for a worker before the webhook answers 429
+
+WORKER_ID = None  # Set in the worker processes of WEBHOOK_WORKERS mode
+
+def build_application(updater=True):
+    # Same pool size python-telegram-bot uses by default
+    builder = ApplicationBuilder().token(BOT_TOKEN).request(InstrumentedRequest(connection_pool_size=256))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    if not updater:
+        builder = builder.updater(None)
+
+    # post_stop rather than post_shutdown, so draining still has a working bot
+    application = builder.post_init(on_startup).post_stop(on_shutdown).build()
 
     # Adding CommandHandlers
     application.add_handler(CommandHandler("start", start))
@@ -476,27 +1682,480 @@ def main():
     application.add_handler(CommandHandler("listgroup", list_groups))
     application.add_handler(CommandHandler("countuser", count_users))
     application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcaststatus", broadcast_status))
     application.add_handler(CommandHandler("settimer", set_timer))
     application.add_handler(CommandHandler("autodlt", toggle_auto_delete))
+    application.add_handler(CommandHandler("stats", show_stats))
 
-    # Handling new chat members
-    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_member))
+    # Keep the admin cache in sync with promotions and demotions
+    application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
 
-    # Handling new messages (excluding edited messages)
-    application.add_handler(MessageHandler(filters.ALL & ~filters.UpdateType.EDITED_MESSAGE, handle_new_message))
+    # Keep the group index in sync when the bot is added, promoted or removed
+    application.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
 
-    # Handling edited messages
-    application.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, handle_edited_message))
+    # New messages, edits and new chat members all go through one routing pass
+    application.add_handler(MessageHandler(filters.ALL, route_update), group=ROUTE_GROUP)
 
-    # Handling message deletion
-    application.add_handler(MessageHandler(filters.ALL & ~filters.UpdateType.EDITED_MESSAGE, delete_message))
+    return application
 
-    # Add auto delete handler for messages
-    application.add_handler(MessageHandler(filters.ALL, handle_auto_delete))  # Auto delete handler added here
+async def register_webhook(bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+def stop_on_signals(stop):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+# Run until stop is set. ready and servers let the fake Telegram harness find the port.
+async def serve_webhook(stop, ready=None, servers=None):
+    application = build_application(updater=False)
+
+    async def on_update(body):
+        await application.update_queue.put(parse_update(body, application.bot))
+
+    server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, on_update)
+    async with application:
+        # post_init and post_stop only run on their own under run_polling()
+        await on_startup(application)
+        await application.start()
+        await server.start()
+        await register_webhook(application.bot)
+        log.info("Webhook listening on %s:%s%s", WEBHOOK_LISTEN, server.port, WEBHOOK_PATH)
+        if servers is not None:
+            servers.append(server)
+        if ready:
+            ready.set()
+
+        await stop.wait()
+        await server.stop()
+        await application.stop()
+        await on_shutdown(application)
+
+# Give each worker its own deletions file and metrics endpoint, and its share of the send rate
+def use_worker_files(worker_id):
+    global WORKER_ID, DELETIONS_FILE, METRICS_PORT
+    WORKER_ID = worker_id
+    DELETIONS_FILE = shard_file(DELETIONS_FILE, worker_id)
+    if METRICS_PORT:
+        METRICS_PORT += worker_id  # One endpoint per worker
+    outbound.bucket = TokenBucket(OUTBOUND_RATE / WEBHOOK_WORKERS)  # Workers split the global limit between them
+
+# Deal the deletions of every worker file, and of the single process file, out
+# to the files of the workers about to start. Run before they start.
+def redistribute_deletions(workers):
+    targets = [DELETIONS_FILE] if workers <= 1 else [shard_file(DELETIONS_FILE, i) for i in range(workers)]
+    base, ext = os.path.splitext(DELETIONS_FILE)
+    found = [path for path in [DELETIONS_FILE, *glob.glob(f"{base}.*{ext}")] if os.path.exists(path)]
+    if set(found) <= set(targets):
+        return
+
+    entries = []
+    for path in found:
+        try:
+            entries += read_deletions(path)
+        except (json.JSONDecodeError, TypeError) as e:
+            log.error("Error loading %s: %s", path, e)
+    for i, path in enumerate(targets):
+        write_json(path, [entry for entry in entries if shard_of(unpack_deletion(entry)[1], len(targets)) == i])
+    for path in set(found) - set(targets):
+        os.remove(path)
+    log.info("Moved %d pending deletions to the files of %d workers.", len(entries), len(targets))
+
+def webhook_worker(worker_id, queue, owner_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The webhook process tells workers when to stop
+    log_pipeline.start()
+    use_worker_files(worker_id)
+    asyncio.run(consume_shared_queue(queue, owner_queue if worker_id == 0 else None))
+
+SYNC_GROUP = -2  # Handler group for sync_store, runs before everything else
+
+async def sync_store(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if store.poll_changes() and store.config_changed():
+        load_store_config()
+
+async def consume_shared_queue(queue, owner_queue=None):
+    application = build_application(updater=False)
+    application.add_handler(TypeHandler(Update, sync_store), group=SYNC_GROUP)
+    loop = asyncio.get_running_loop()
+
+    async def consume(source):
+        while True:
+            body = await loop.run_in_executor(None, source.get)
+            if body is None:  # Stop signal from the webhook process
+                break
+            await put_raw_update(application, body)
+
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await asyncio.gather(*(consume(source) for source in (queue, owner_queue) if source is not None))
+        await application.stop()
+        await on_shutdown(application)
+
+# Update.de_json fails on bodies that aren't updates with more than ValueError,
+# e.g. TypeError without an update_id or KeyError for a message without a date
+def parse_update(body, bot):
+    try:
+        return Update.de_json(json.loads(body), bot)
+    except (TypeError, KeyError, AttributeError) as e:
+        raise ValueError(f"not an update: {e!r}") from e
+
+# A bad body is dropped, it must not end the loop that takes updates off the queue
+async def put_raw_update(application, body):
+    try:
+        update = parse_update(body, application.bot)
+    except ValueError as e:
+        log.warning("Dropping malformed update: %s", e)
+        return
+    await application.update_queue.put(update)
+
+# The raw JSON object of an update, for the processes that only route updates
+def read_update(body):
+    update = json.loads(body)
+    if not isinstance(update, dict):
+        raise ValueError("not an update")
+    return update
+
+async def serve_shared_queue(queue, owner_queue, stop):
+    import queue as queue_module
+
+    async def on_update(body):
+        target = owner_queue if is_coordinator_update(read_update(body)) else queue
+        try:
+            target.put_nowait(body)
+        except queue_module.Full:
+            return 429  # Telegram retries the update later
+
+    server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, on_update)
+    await server.start()
+    application = build_application(updater=False)
+    async with application:
+        await register_webhook(application.bot)
+    log.info("Webhook listening on %s:%s%s for %d workers", WEBHOOK_LISTEN, server.port, WEBHOOK_PATH, WEBHOOK_WORKERS)
+    await stop.wait()
+    await server.stop()
+
+# Sharded mode
+# WEBHOOK_SHARDS above 1 runs that many shard processes. The webhook process
+# becomes the coordinator from sharding.py: it routes each update to the shard
+# that owns its chat and answers the owner commands that need every shard by
+# querying all of them. On the first sharded start the current state files are
+# split so each shard gets the chats it owns, after that the shard count is fixed.
+SHARD_LAYOUT_FILE = "shards.json"
+
+# The files left after a split are out of date, a start that doesn't use the shards must not run on them
+def refuse_split_state():
+    try:
+        with open(SHARD_LAYOUT_FILE, "r") as f:
+            layout = json.load(f)
+    except FileNotFoundError:
+        return
+    raise SystemExit(f"The state is split into {layout['shards']} shards, "
+                     f"set BOT_MODE=webhook and WEBHOOK_SHARDS={layout['shards']}.")
+
+# Owner commands the coordinator answers itself, with workers they all go to worker 0
+COORDINATOR_COMMANDS = {"auth", "unauth", "listgroup", "countuser", "broadcast", "broadcaststatus", "stats"}
+
+coordinator = None  # Coordinator in the webhook process of sharded mode
+
+def sum_summaries(results):
+    total = {}
+    for result in results:
+        for key, value in result.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+def merge_stats(results):
+    return {
+        "counts": sum_summaries([result["counts"] for result in results]),
+        "routes": sum_summaries([result["routes"] for result in results]),
+        "queued": [sum(column) for column in zip(*(result["queued"] for result in results))],
+        "worst": {key: max(result["worst"][key] for result in results) for key in results[0]["worst"]},
+    }
+
+def merge_broadcast_starts(results):
+    started = [recipients for recipients in results if recipients is not None]
+    return sum(started) if started else None
+
+def merge_broadcasts(results):
+    results = [result for result in results if result]
+    if not results:
+        return None
+    stats = sum_summaries([{k: v for k, v in result["stats"].items() if k != "eta"} for result in results])
+    stats["eta"] = stats["remaining"] / stats["rate"] if stats["rate"] > 0 else None
+    return {"stats": stats, "finished": all(result["finished"] for result in results)}
+
+# name -> (function run on a shard, merge of every shard's answer)
+SHARD_QUERIES = {
+    "users": (user_summary, sum_summaries),
+    "groups": (group_summary, sum_summaries),
+    "stats": (stats_summary, merge_stats),
+    "broadcast": (start_broadcast_job, merge_broadcast_starts),
+    "broadcast_status": (broadcast_summary, merge_broadcasts),
+    "authorize_global": (lambda application, user_id: authorize_global(user_id), lambda results: None),
+    "unauthorize_global": (lambda application, user_id: unauthorize_global(user_id), any),
+}
+
+# Calls a shard forwards to the shard that owns a chat
+SHARD_CALLS = {
+    "note_started_user": note_started_user,
+}
+
+# Run a query here, or on every shard when this is the coordinator. Worker 0
+# adds what the other workers reported.
+async def collect(application, name, *args):
+    function, merge = SHARD_QUERIES[name]
+    if coordinator is None:
+        if WORKER_ID is not None:
+            reports = read_worker_reports()
+            if name == "stats":
+                return merge_stats([function(application)] + [report["stats"] for report in reports])
+            fold_group_activity(reports)
+        return function(application, *args)
+    return merge(await coordinator.query(name, *args))
+
+def partition_data(data, shard, shards):
+    def owned(chat_id):
+        return shard_of(chat_id, shards) == shard
+
+    return {
+        "started_users": [user_id for user_id in data.get("started_users", []) if owned(user_id)],
+        "group_ids": [chat_id for chat_id in data.get("group_ids", []) if owned(chat_id)],
+        "authorized_users": data.get("authorized_users", []),
+        "authorized_user_ids": data.get("authorized_user_ids", []),
+        "global_authorized_users": data.get("global_authorized_users", []),  # Every shard needs these
+        "group_authorized_users": {k: v for k, v in data.get("group_authorized_users", {}).items() if owned(k)},
+        "group_settings": {k: v for k, v in data.get("group_settings", {}).items() if owned(k)},
+        "dead_chats": {k: v for k, v in data.get("dead_chats", {}).items() if owned(k)},
+    }
+
+def split_into_shards(shards):
+    try:
+        with open(SHARD_LAYOUT_FILE, "r") as f:
+            layout = json.load(f)
+    except FileNotFoundError:
+        layout = None
+    if layout:
+        if layout["shards"] != shards:
+            raise SystemExit(f"The state is split into {layout['shards']} shards, set WEBHOOK_SHARDS={layout['shards']}.")
+        return
+
+    def read(path, default):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    load_state()
+    data = store.export_data() if store else snapshot_data()
+    redistribute_deletions(1)  # Gather what workers left behind
+    try:
+        deletions = read_deletions(DELETIONS_FILE)
+    except FileNotFoundError:
+        deletions = []
+    index = read(GROUP_INDEX_FILE, {})
+    for shard in range(shards):
+        write_json(shard_file(DATA_FILE, shard), partition_data(data, shard, shards))
+        write_json(shard_file(DELETIONS_FILE, shard),
+                   [entry for entry in deletions if shard_of(unpack_deletion(entry)[1], shards) == shard])
+        write_json(shard_file(GROUP_INDEX_FILE, shard),
+                   {k: v for k, v in index.items() if shard_of(k, shards) == shard})
+    write_json(SHARD_LAYOUT_FILE, {"shards": shards})
+    log.info("Split the state into %d shards.", shards)
+
+def is_coordinator_update(update):
+    message = update.get("message")
+    if not message or message.get("from", {}).get("id") != int(OWNER_ID):
+        return False
+    text = message.get("text", "")
+    parts = text[1:].split(maxsplit=1) if text.startswith("/") else []
+    return bool(parts) and parts[0].split("@")[0].lower() in COORDINATOR_COMMANDS
+
+def build_coordinator_application():
+    builder = ApplicationBuilder().token(BOT_TOKEN).updater(None)
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    application = builder.build()
+    application.add_handler(CommandHandler("auth", authorize_user))
+    application.add_handler(CommandHandler("unauth", unauthorize_user))
+    application.add_handler(CommandHandler("listgroup", list_groups))
+    application.add_handler(CommandHandler("countuser", count_users))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcaststatus", broadcast_status))
+    application.add_handler(CommandHandler("stats", show_stats))
+    return application
+
+def shard_worker(shard, inbox, outbox):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The coordinator tells shards when to stop
+    log_pipeline.start()
+    asyncio.run(consume_shard_inbox(shard, inbox, outbox))
+
+async def consume_shard_inbox(shard, inbox, outbox):
+    global shard_link
+    shard_link = ShardLink(shard, SHARD_COUNT, outbox)
+    application = build_application(updater=False)
+    loop = asyncio.get_running_loop()
+    async with application:
+        await on_startup(application)
+        await application.start()
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            if message is None:  # Stop signal from the coordinator
+                break
+            kind, *args = message
+            if kind == "update":
+                await put_raw_update(application, args[0])
+            elif kind == "query":
+                answer_query(application, *args)
+            elif kind == "call":
+                run_shard_call(*args)
+        await application.stop()
+        await on_shutdown(application)
+
+def run_shard_call(name, args):
+    try:
+        SHARD_CALLS[name](*args)
+    except Exception:
+        log.exception("Forwarded call %s failed", name)
+
+def answer_query(application, request_id, name, args):
+    try:
+        result = SHARD_QUERIES[name][0](application, *args)
+    except Exception as e:
+        log.exception("Shard query %s failed", name)
+        shard_link.fail(request_id, e)
+        return
+    shard_link.reply(request_id, result)
+
+# Run until stop is set. ready and servers let the fake Telegram harness find the port.
+async def serve_sharded(stop, ready=None, servers=None):
+    global coordinator
+    import multiprocessing
+    import queue as queue_module
+
+    split_into_shards(WEBHOOK_SHARDS)
+    context = multiprocessing.get_context("spawn")
+    inboxes = [context.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_SHARDS)]
+    outbox = context.Queue()
+    shards = []
+    for shard in range(WEBHOOK_SHARDS):
+        # Spawned shards read these while importing this module, before loading their state
+        os.environ["BOT_SHARD"] = str(shard)
+        os.environ["BOT_SHARDS"] = str(WEBHOOK_SHARDS)
+        process = context.Process(target=shard_worker, args=(shard, inboxes[shard], outbox))
+        process.start()
+        shards.append(process)
+    del os.environ["BOT_SHARD"], os.environ["BOT_SHARDS"]
+
+    coordinator = Coordinator(inboxes, outbox)
+    application = build_coordinator_application()
+
+    async def on_update(body):
+        update = read_update(body)
+        if is_coordinator_update(update):
+            await application.update_queue.put(parse_update(body, application.bot))
+            return
+        try:
+            coordinator.send_update(update, body)
+        except queue_module.Full:
+            return 429  # Telegram retries the update later
+
+    server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, on_update)
+    async with application:
+        coordinator.start()
+        await application.start()
+        await server.start()
+        await register_webhook(application.bot)
+        log.info("Webhook listening on %s:%s%s for %d shards", WEBHOOK_LISTEN, server.port, WEBHOOK_PATH, WEBHOOK_SHARDS)
+        if servers is not None:
+            servers.append(server)
+        if ready:
+            ready.set()
+
+        await stop.wait()
+        await server.stop()
+        await application.stop()
+
+    for inbox in inboxes:
+        inbox.put(None)
+    loop = asyncio.get_running_loop()
+    for process in shards:
+        await loop.run_in_executor(None, process.join)
+    await coordinator.stop()
+    coordinator = None
+
+def run_webhook():
+    async def serve_single():
+        stop = asyncio.Event()
+        stop_on_signals(stop)
+        await serve_webhook(stop)
+
+    async def serve_shards():
+        stop = asyncio.Event()
+        stop_on_signals(stop)
+        await serve_sharded(stop)
+
+    if not WEBHOOK_SECRET:
+        raise SystemExit("Set WEBHOOK_SECRET, it is also given to setWebhook so only Telegram can post updates.")
+
+    if WEBHOOK_SHARDS > 1:
+        if WEBHOOK_WORKERS > 1:
+            raise SystemExit("Use either WEBHOOK_SHARDS or WEBHOOK_WORKERS, not both.")
+        asyncio.run(serve_shards())
+        return
+
+    if WEBHOOK_WORKERS <= 1:
+        redistribute_deletions(1)
+        asyncio.run(serve_single())
+        return
+
+    if STORAGE_BACKEND != "sqlite":
+        raise SystemExit("WEBHOOK_WORKERS above 1 needs STORAGE_BACKEND=sqlite so workers can share state.")
+
+    import multiprocessing
+
+    redistribute_deletions(WEBHOOK_WORKERS)
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    owner_queue = context.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    workers = [context.Process(target=webhook_worker, args=(i, queue, owner_queue)) for i in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    async def serve_ingress():
+        stop = asyncio.Event()
+        stop_on_signals(stop)
+        await serve_shared_queue(queue, owner_queue, stop)
+
+    try:
+        asyncio.run(serve_ingress())
+    finally:
+        for _ in workers:
+            queue.put(None)
+        owner_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+def main():
+    log_pipeline.start()
+    if BOT_MODE != "webhook" or WEBHOOK_SHARDS <= 1:
+        refuse_split_state()  # Before the application, which would swallow the SystemExit
+    if BOT_MODE == "webhook":
+        run_webhook()
+        return
+
+    redistribute_deletions(1)
+    application = build_application()
 
     # Start the bot
-    application.run_polling()
+    # chat_member updates are only delivered when requested explicitly
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
-
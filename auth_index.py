@@ -0,0 +1,148 @@
+from array import array
+from bisect import bisect_left
+
+# Authorization index
+# Answers "is this user exempt in this chat" for edited messages, from one
+# collection of user IDs for global authorizations and one per chat. IDs are
+# normalized to int on the way in, so IDs loaded from JSON as strings can't
+# silently miss. Up to COMPACT_AFTER IDs the collections are sets, the fastest
+# lookup. Past that, build() keeps sorted arrays of 64-bit ints instead, which
+# cost 8 bytes per ID against about 70 for a set slot plus an int object.
+# Binary search over the arrays is slower than a set lookup, so a Bloom filter
+# over every authorized user lets the common case, a user with no
+# authorization anywhere, return after three bit probes taken from a single
+# multiplicative hash. The layout is picked when the index is built.
+
+BLOOM_MAX_BITS = 1 << 21  # Three 21-bit slices of one 64-bit hash
+BLOOM_REBUILD_AFTER = 1000  # Removals before the Bloom filter is rebuilt to drop stale bits
+COMPACT_AFTER = 100_000  # Authorized IDs above which the index switches from sets to arrays
+
+
+def contains(ids, value):
+    i = bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
+
+
+def insert(ids, value):
+    i = bisect_left(ids, value)
+    if i < len(ids) and ids[i] == value:
+        return False
+    ids.insert(i, value)
+    return True
+
+
+def remove(ids, value):
+    i = bisect_left(ids, value)
+    if i < len(ids) and ids[i] == value:
+        del ids[i]
+        return True
+    return False
+
+
+class BloomFilter:
+    def __init__(self, bits):
+        # Round up to a power of two so positions are masks, not modulos
+        bits = min(BLOOM_MAX_BITS, max(8, 1 << (bits - 1).bit_length()))
+        self.mask = bits - 1
+        self.data = bytearray(bits // 8)
+
+    def add(self, value):
+        h = value * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF
+        mask = self.mask
+        for position in (h & mask, (h >> 21) & mask, (h >> 42) & mask):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+
+class AuthIndex:
+    def __init__(self, bloom_bits=BLOOM_MAX_BITS, compact_after=COMPACT_AFTER):
+        self.global_ids = set()
+        self.chat_ids = {}  # chat_id -> user IDs authorized in that chat
+        self.bloom_bits = bloom_bits  # 0 disables the Bloom prefilter of the compact layout
+        self.compact_after = compact_after
+        self.compact = False  # Sorted arrays instead of sets
+        self.bloom = None
+        self.removals = 0
+
+    # Build once from the global IDs and (chat_id, user_ids) pairs, IDs may be strings
+    def build(self, global_ids, chat_ids):
+        self.global_ids = {int(user_id) for user_id in global_ids}
+        self.chat_ids = {int(chat_id): {int(user_id) for user_id in user_ids} for chat_id, user_ids in chat_ids}
+        self.compact = len(self.global_ids) + sum(map(len, self.chat_ids.values())) > self.compact_after
+        if self.compact:
+            self.global_ids = array("q", sorted(self.global_ids))
+            self.chat_ids = {chat_id: array("q", sorted(user_ids)) for chat_id, user_ids in self.chat_ids.items()}
+        self.rebuild_bloom()
+
+    def rebuild_bloom(self):
+        self.removals = 0
+        if not self.compact or not self.bloom_bits:
+            self.bloom = None
+            return
+        self.bloom = BloomFilter(self.bloom_bits)
+        for user_id in self.global_ids:
+            self.bloom.add(user_id)
+        for user_ids in self.chat_ids.values():
+            for user_id in user_ids:
+                self.bloom.add(user_id)
+
+    def _removed(self):
+        self.removals += 1
+        if self.bloom is not None and self.removals >= BLOOM_REBUILD_AFTER:
+            self.rebuild_bloom()
+
+    def is_exempt(self, chat_id, user_id):
+        if not self.compact:
+            if user_id in self.global_ids:
+                return True
+            user_ids = self.chat_ids.get(chat_id)
+            return user_ids is not None and user_id in user_ids
+        bloom = self.bloom
+        if bloom is not None:
+            # Same probes as BloomFilter.add, inlined since this runs on every edit
+            h = user_id * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF
+            data, mask = bloom.data, bloom.mask
+            a, b, c = h & mask, (h >> 21) & mask, (h >> 42) & mask
+            if not data[a >> 3] >> (a & 7) & data[b >> 3] >> (b & 7) & data[c >> 3] >> (c & 7) & 1:
+                return False
+        if contains(self.global_ids, user_id):
+            return True
+        user_ids = self.chat_ids.get(chat_id)
+        return user_ids is not None and contains(user_ids, user_id)
+
+    def add_global(self, user_id):
+        return self._add(self.global_ids, int(user_id))
+
+    def discard_global(self, user_id):
+        user_id = int(user_id)
+        if not self.compact:
+            if user_id not in self.global_ids:
+                return False
+            self.global_ids.discard(user_id)
+            return True
+        removed = remove(self.global_ids, user_id)
+        if removed:
+            self._removed()
+        return removed
+
+    def add_in_chat(self, chat_id, user_id):
+        user_ids = self.chat_ids.get(int(chat_id))
+        if user_ids is None:
+            user_ids = self.chat_ids[int(chat_id)] = array("q") if self.compact else set()
+        return self._add(user_ids, int(user_id))
+
+    def _add(self, ids, user_id):
+        if not self.compact:
+            if user_id in ids:
+                return False
+            ids.add(user_id)
+            return True
+        if self.bloom is not None:
+            self.bloom.add(user_id)
+        return insert(ids, user_id)
+
+    # Lists for the JSON snapshot
+    def global_list(self):
+        return sorted(self.global_ids)
+
+    def chat_lists(self):
+        return {chat_id: sorted(user_ids) for chat_id, user_ids in self.chat_ids.items()}
@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_telegram import FakeTelegram, synthetic_updates
+
+# Load benchmarks for the bot.
+# Replays synthetic group traffic through the real handlers against the fake
+# Bot API and measures handler latency, event-loop lag, outbound API calls,
+# memory per pending deletion, state saves, broadcast throughput and how long
+# a fresh process takes to start on a large data file. Results are written as
+# JSON, and --compare prints the change against an earlier run.
+#
+#   python bench_bot.py --groups 50 --rate 200 --duration 10 --output before.json
+#   python bench_bot.py --groups 50 --rate 200 --duration 10 --compare before.json
+
+LOOP_LAG_INTERVAL = 0.01  # Seconds between event-loop lag samples
+
+# Run in a fresh interpreter by bench_cold_start(), prints one JSON line
+COLD_START_SCRIPT = """
+import asyncio, json, time
+started = time.perf_counter()
+import Copyrightsaver_bot as bot
+imported = time.perf_counter() - started
+
+async def main():
+    application = bot.build_application(updater=False)
+    started = time.perf_counter()
+    await bot.on_startup(application)
+    startup = time.perf_counter() - started
+    started = time.perf_counter()
+    await bot.on_shutdown(application)
+    return startup, time.perf_counter() - started
+
+startup, shutdown = asyncio.run(main())
+print(json.dumps({
+    "import_ms": imported * 1000,
+    "startup_ms": startup * 1000,
+    "phases_ms": {name: seconds * 1000 for name, seconds in bot.startup_seconds.items()},
+    "shutdown_ms": shutdown * 1000,
+}))
+"""
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def monitor_loop_lag(samples):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        samples.append(time.perf_counter() - started - LOOP_LAG_INTERVAL)
+
+
+async def bench_traffic(bot, fake, args):
+    from telegram import Update
+
+    bot.group_settings.default = bot.ChatConfig(delete_timer=args.delete_after)
+    application = bot.build_application(updater=False)
+    latencies = []
+    lag_samples = []
+
+    async def timed(update):
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+    async with application:
+        await bot.on_startup(application)
+        calls_before = len(fake.calls)
+        lag_task = asyncio.create_task(monitor_loop_lag(lag_samples))
+
+        updates = synthetic_updates(args.groups, edit_ratio=args.edit_ratio,
+                                    media_ratio=args.media_ratio, seed=args.seed)
+        total = int(args.rate * args.duration)
+        tasks = []
+        started = time.perf_counter()
+        for i in range(total):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = Update.de_json(next(updates), application.bot)
+            tasks.append(asyncio.create_task(timed(update)))
+        await asyncio.gather(*tasks)
+        handled_in = time.perf_counter() - started
+
+        # Let every scheduled deletion come due and go out
+        await asyncio.sleep(args.delete_after + bot.DELETION_BATCH_WINDOW + 1)
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        await bot.on_shutdown(application)
+
+    methods = {}
+    for _, method, _ in fake.calls[calls_before:]:
+        methods[method] = methods.get(method, 0) + 1
+    api_calls = sum(methods.values())
+    return {
+        "updates": total,
+        "updates_per_second": total / handled_in,
+        "handler_p50_ms": percentile(latencies, 0.50) * 1000,
+        "handler_p99_ms": percentile(latencies, 0.99) * 1000,
+        "loop_lag_p50_ms": percentile(lag_samples, 0.50) * 1000,
+        "loop_lag_p99_ms": percentile(lag_samples, 0.99) * 1000,
+        "loop_lag_max_ms": max(lag_samples, default=0.0) * 1000,
+        "api_calls": api_calls,
+        "api_calls_per_second": api_calls / elapsed,
+        "api_calls_by_method": methods,
+        "rate_limited": fake.rate_limited,
+        "outbound": dict(bot.outbound.metrics),
+        "routes_ms": {
+            route: {"p99": bot.update_seconds.quantile(0.99, route) * 1000, "max": bot.update_seconds.max(route) * 1000}
+            for (route,) in bot.update_seconds.values
+        },
+    }
+
+
+async def bench_deletion_memory(bot, count):
+    # Current scheduler: one heap entry per pending deletion
+    bot.pending_deletions.clear()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        bot.schedule_deletion(-1001000000000 - i % 100, i, 3600)
+    heap_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    bot.pending_deletions.clear()
+
+    # The old approach for reference: one sleeping task per message
+    async def sleep_then_delete(chat_id, message_id, delay):
+        await asyncio.sleep(delay)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = [asyncio.create_task(sleep_then_delete(-1001000000000 - i % 100, i, 3600)) for i in range(count)]
+    await asyncio.sleep(0)  # Let every task reach its sleep
+    task_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "pending": count,
+        "bytes_per_pending_deletion": heap_bytes / count,
+        "bytes_per_task_deletion": task_bytes / count,
+    }
+
+
+def bench_save_data(bot, users):
+    bot.started_users.update(range(1_000_000, 1_000_000 + users))
+    started = time.perf_counter()
+    bot.save_data()
+    save_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for user_id in range(users):
+        bot.log_change("add", "started_users", user_id)
+    log_seconds = (time.perf_counter() - started) / users
+    bot.wal_buffer.clear()
+    bot.started_users.difference_update(range(1_000_000, 1_000_000 + users))
+
+    return {
+        "users": users,
+        "save_data_ms": save_seconds * 1000,
+        "log_change_us": log_seconds * 1_000_000,
+    }
+
+
+async def bench_broadcast(bot, fake, recipients):
+    from broadcast_engine import Broadcast
+    from outbound_queue import OutboundQueue
+
+    application = bot.build_application(updater=False)
+    outbound = OutboundQueue()
+    async with application:
+        outbound.start()
+        job = Broadcast(application.bot, outbound, from_chat_id=1, message_id=1,
+                        recipients=list(range(1, recipients + 1)), report_chat_id=1)
+        started = time.perf_counter()
+        await job.run()
+        elapsed = time.perf_counter() - started
+        await outbound.stop()
+    return {
+        "recipients": recipients,
+        "seconds": elapsed,
+        "messages_per_second": recipients / elapsed,
+        "sent": job.sent,
+        "failed": job.failed,
+    }
+
+
+def bench_auth(authorized, chats, lookups, bloom_bits, seed):
+    from auth_index import AuthIndex
+
+    rng = random.Random(seed)
+    chat_ids = [-1001000000000 - i for i in range(chats)]
+    global_ids = [rng.randrange(1, 10**10) for _ in range(authorized // 10)]
+    chat_pairs = {chat_id: [rng.randrange(1, 10**10) for _ in range(authorized // chats)] for chat_id in chat_ids}
+    # Edits mostly come from users with no authorization anywhere
+    queries = [(rng.choice(chat_ids), rng.randrange(1, 10**10)) for _ in range(lookups)]
+
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        structure = build()
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return structure, size
+
+    def time_lookups(is_exempt):
+        started = time.perf_counter()
+        for chat_id, user_id in queries:
+            is_exempt(chat_id, user_id)
+        return (time.perf_counter() - started) / lookups * 1e9
+
+    # The old layout: a global set and a set per chat
+    (global_set, chat_sets), sets_bytes = measure(
+        lambda: (set(global_ids), {chat_id: set(user_ids) for chat_id, user_ids in chat_pairs.items()}))
+
+    def sets_exempt(chat_id, user_id):
+        if user_id in global_set:
+            return True
+        return chat_id in chat_sets and user_id in chat_sets[chat_id]
+
+    results = {"authorized": len(global_ids) + sum(map(len, chat_pairs.values())),
+               "sets": {"bytes": sets_bytes, "lookup_ns": time_lookups(sets_exempt)}}
+    # The compact layout, which AuthIndex only picks past COMPACT_AFTER IDs, with and without the Bloom filter
+    for name, bits in (("index", 0), ("index_bloom", bloom_bits)):
+        def build(bits=bits):
+            index = AuthIndex(bits, compact_after=0)
+            index.build(global_ids, chat_pairs.items())
+            return index
+        index, index_bytes = measure(build)
+        results[name] = {"bytes": index_bytes, "lookup_ns": time_lookups(index.is_exempt)}
+    return results
+
+
+# Start and stop the bot in a fresh interpreter on a generated data file
+def bench_cold_start(users, groups, pending):
+    rng = random.Random(1)
+    group_ids = [-1001000000000 - i for i in range(groups)]
+    directory = tempfile.mkdtemp(prefix="bench_cold_start_")
+    with open(os.path.join(directory, "data.json"), "w") as f:
+        json.dump({
+            "started_users": [rng.randrange(10**9, 10**10) for _ in range(users)],
+            "group_ids": group_ids,
+            "group_settings": {chat_id: {"delete_timer": 600, "auto_delete": True} for chat_id in group_ids[::2]},
+        }, f)
+    due_ts = time.time() + 3600
+    with open(os.path.join(directory, "pending_deletions.json"), "w") as f:
+        json.dump([[due_ts + i, group_ids[i % groups], i] for i in range(pending)], f)
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), METRICS_PORT="0")
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT], cwd=directory, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    total = time.perf_counter() - started
+    results = json.loads(output.strip().splitlines()[-1])
+    results.update(users=users, groups=groups, pending=pending, process_ms=total * 1000)
+    return results
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def print_results(results, baseline=None):
+    current = flatten(results)
+    previous = flatten(baseline) if baseline else {}
+    for key, value in current.items():
+        line = f"{key:<45} {value:>14.3f}"
+        if key in previous and previous[key]:
+            change = (value - previous[key]) / previous[key] * 100
+            line += f"   {change:+7.1f}% (was {previous[key]:.3f})"
+        print(line)
+
+
+async def run(args):
+    fake = FakeTelegram(latency=args.latency, rate_limit_every=args.rate_limit_every)
+    await fake.start()
+
+    # The bot reads and writes its data files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="bench_bot_"))
+    os.environ["BOT_API_URL"] = fake.base_url
+    import Copyrightsaver_bot as bot
+    bot.log_pipeline.start()
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if isinstance(value, (int, float))},
+        "traffic": await bench_traffic(bot, fake, args),
+        "deletion_memory": await bench_deletion_memory(bot, args.pending),
+        "save_data": bench_save_data(bot, args.users),
+        "broadcast": await bench_broadcast(bot, fake, args.recipients),
+        "auth": bench_auth(args.authorized, args.groups, args.lookups, args.bloom_bits, args.seed),
+        "cold_start": bench_cold_start(args.cold_users, args.cold_groups, args.pending),
+    }
+    await fake.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic traffic through the bot against a fake Bot API.")
+    parser.add_argument("--groups", type=int, default=20, help="Groups sending traffic")
+    parser.add_argument("--rate", type=float, default=100, help="Updates per second")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds of traffic")
+    parser.add_argument("--edit-ratio", type=float, default=0.1, help="Share of updates that are edits")
+    parser.add_argument("--media-ratio", type=float, default=0.2, help="Share of new messages that are photos")
+    parser.add_argument("--delete-after", type=float, default=2, help="Auto-delete timer in seconds")
+    parser.add_argument("--latency", type=float, default=0.02, help="Fake Bot API latency in seconds")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth API call with 429")
+    parser.add_argument("--pending", type=int, default=100_000, help="Pending deletions for the memory benchmark")
+    parser.add_argument("--users", type=int, default=100_000, help="Users for the save benchmark")
+    parser.add_argument("--recipients", type=int, default=100, help="Recipients for the broadcast benchmark")
+    parser.add_argument("--authorized", type=int, default=100_000, help="Authorizations for the auth benchmark")
+    parser.add_argument("--lookups", type=int, default=200_000, help="Lookups for the auth benchmark")
+    parser.add_argument("--bloom-bits", type=int, default=1 << 21, help="Bloom filter size for the auth benchmark")
+    parser.add_argument("--cold-users", type=int, default=1_000_000, help="Started users for the cold-start benchmark")
+    parser.add_argument("--cold-groups", type=int, default=10_000, help="Groups for the cold-start benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    results = asyncio.run(run(args))
+    print()
+    print_results(results, baseline)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
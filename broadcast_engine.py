@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from outbound_queue import BULK
+
+# Broadcast engine
+# A broadcast copies one message to every recipient with copy_message, so
+# every content type goes through the same path. A pool of workers hands the
+# sends to the bot's OutboundQueue at the lowest priority. The queue keeps the
+# broadcast under Telegram's global limit, behind deletions and announcements,
+# and retries RetryAfter. Progress is checkpointed so a restarted bot picks
+# the broadcast up where it stopped.
+
+BROADCAST_JOB_FILE = "broadcast_job.json"  # Message and recipient list, written once
+BROADCAST_PROGRESS_FILE = "broadcast_progress.json"  # Small checkpoint, rewritten often
+BROADCAST_WORKERS = 20  # Concurrent sends
+BROADCAST_CHECKPOINT_INTERVAL = 5  # Seconds between progress checkpoints
+
+log = logging.getLogger("copyrightsaver.broadcast")
+
+
+def write_json(path, data):
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_file, path)
+
+
+class Broadcast:
+    def __init__(self, bot, outbound, from_chat_id, message_id, recipients, report_chat_id,
+                 position=0, done_after=(), sent=0, failed=0, on_result=None):
+        self.bot = bot
+        self.outbound = outbound  # OutboundQueue that paces the sends
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.recipients = recipients
+        self.report_chat_id = report_chat_id
+        self.on_result = on_result  # Called with (chat_id, error or None) after each send
+        # Every recipient before position is done, plus the indexes in done_after
+        self.position = position
+        self.done_after = set(done_after)
+        self.next_index = position
+        self.sent = sent
+        self.failed = failed
+        self.started = time.monotonic()
+        self.sent_at_start = sent + failed
+        self.finished = False
+        self.stopping = False
+
+    # Checkpoints
+
+    def save_job(self):
+        write_json(BROADCAST_JOB_FILE, {
+            "from_chat_id": self.from_chat_id,
+            "message_id": self.message_id,
+            "report_chat_id": self.report_chat_id,
+            "recipients": self.recipients,
+        })
+        self.save_progress()
+
+    def save_progress(self):
+        write_json(BROADCAST_PROGRESS_FILE, {
+            "position": self.position,
+            "done_after": sorted(self.done_after),
+            "sent": self.sent,
+            "failed": self.failed,
+        })
+
+    @classmethod
+    def load(cls, bot, outbound, on_result=None):
+        try:
+            with open(BROADCAST_JOB_FILE, "r") as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(BROADCAST_PROGRESS_FILE, "r") as f:
+                progress = json.load(f)
+        except FileNotFoundError:
+            progress = {}
+        return cls(bot, outbound, job["from_chat_id"], job["message_id"], job["recipients"], job["report_chat_id"],
+                   on_result=on_result, **progress)
+
+    @staticmethod
+    def clear():
+        for path in (BROADCAST_JOB_FILE, BROADCAST_PROGRESS_FILE):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Sending
+
+    def mark_done(self, index):
+        self.done_after.add(index)
+        while self.position in self.done_after:
+            self.done_after.discard(self.position)
+            self.position += 1
+
+    async def send(self, chat_id):
+        try:
+            await self.outbound.submit(chat_id, BULK, lambda: self.bot.copy_message(
+                chat_id=chat_id, from_chat_id=self.from_chat_id, message_id=self.message_id))
+        except Exception as e:
+            log.warning("Failed to send to %s: %s", chat_id, e, extra={"chat_id": chat_id})
+            self.report(chat_id, e)
+            return False
+        self.report(chat_id, None)
+        return True
+
+    def report(self, chat_id, error):
+        if self.on_result:
+            self.on_result(chat_id, error)
+
+    async def worker(self):
+        while not self.stopping and self.next_index < len(self.recipients):
+            index = self.next_index
+            self.next_index += 1
+            if index in self.done_after:  # Already sent before the restart
+                continue
+            if await self.send(self.recipients[index]):
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.mark_done(index)
+
+    async def checkpointer(self):
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            self.save_progress()
+
+    # Stop handing out recipients, run() returns once the sends in flight are done
+    def stop(self):
+        self.stopping = True
+
+    async def run(self):
+        checkpointer = asyncio.create_task(self.checkpointer())
+        try:
+            await asyncio.gather(*(self.worker() for _ in range(BROADCAST_WORKERS)))
+        finally:
+            checkpointer.cancel()
+            if self.position >= len(self.recipients):
+                self.finished = True
+                self.clear()
+            else:
+                self.save_progress()
+
+    # Stats for the owner
+
+    def stats(self):
+        done = self.sent + self.failed
+        elapsed = time.monotonic() - self.started
+        rate = (done - self.sent_at_start) / elapsed if elapsed > 0 else 0.0
+        remaining = len(self.recipients) - done
+        return {
+            "total": len(self.recipients),
+            "sent": self.sent,
+            "failed": self.failed,
+            "remaining": remaining,
+            "rate": rate,
+            "eta": remaining / rate if rate > 0 else None,
+        }
@@ -0,0 +1,18 @@
+import pytest
+
+import Copyrightsaver_bot as bot
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    # Empty state with the data files in a temporary directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "state_loaded", False)
+    monkeypatch.setattr(bot, "wal_buffer", [])
+    monkeypatch.setattr(bot, "wal_entries", 0)
+    monkeypatch.setattr(bot, "pending_deletions", [])
+    monkeypatch.setattr(bot, "send_failures", {})
+    monkeypatch.setattr(bot, "group_index", {})
+    bot.group_settings.configs.clear()
+    bot.load_state()
+    return tmp_path
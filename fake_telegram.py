@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+
+from webhook_server import read_http_request, write_http_response, SECRET_HEADER
+
+# Fake Telegram Bot API for running the bot offline.
+# FakeTelegram answers Bot API calls on a local port and records every call,
+# so the bot can be pointed at it with BOT_API_URL. post_update() delivers
+# updates to the bot's webhook the way Telegram would. latency delays every
+# answer and rate_limit_every answers every Nth call with a 429 RetryAfter.
+#
+# Run `python fake_telegram.py` to start the bot in webhook mode against the
+# fake API in a temporary directory, send it a few updates and print the
+# calls it made. `--shards 3` does the same with three shard processes.
+# test_webhook.py drives the bot the same way and checks the calls.
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+SECRET_TOKEN = "fake-secret"  # Webhook secret the bot is started with
+
+
+class FakeTelegram:
+    def __init__(self, listen="127.0.0.1", port=0, latency=0.0, rate_limit_every=0, retry_after=1):
+        self.listen = listen
+        self.port = port
+        self.latency = latency  # Seconds added to every answer
+        self.rate_limit_every = rate_limit_every  # Answer every Nth call with 429, 0 to disable
+        self.retry_after = retry_after
+        self.server = None
+        self.calls = []  # (monotonic time, method, params)
+        self.rate_limited = 0
+        self.message_ids = itertools.count(1_000_000)
+
+    @property
+    def base_url(self):
+        return f"http://{self.listen}:{self.port}/bot"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def calls_to(self, method):
+        return [params for _, name, params in self.calls if name == method]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                _, path, headers, body = request
+                method = path.rsplit("/", 1)[-1]
+                params = self.parse_params(headers, body)
+                self.calls.append((time.monotonic(), method, params))
+                status, payload = await self.respond(method, params, len(self.calls))
+                write_http_response(writer, status, json.dumps(payload).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def parse_params(headers, body):
+        if not headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            return {}  # File uploads are not needed by the bot
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            # python-telegram-bot JSON-encodes everything that isn't a plain string
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def respond(self, method, params, number):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # number is the call's position, counted on arrival so concurrent calls can't skip it
+        if self.rate_limit_every and number % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        return 200, {"ok": True, "result": self.result(method, params)}
+
+    def message(self, chat_id, text=None):
+        chat_type = "private" if int(chat_id) > 0 else "supergroup"
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": chat_type},
+            "from": BOT_USER,
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendSticker"):
+            return self.message(params["chat_id"], params.get("text"))
+        if method == "copyMessage":
+            return {"message_id": next(self.message_ids)}
+        if method == "getChat":
+            full_info = {
+                "accent_color_id": 0,
+                "max_reaction_count": 11,
+                "accepted_gift_types": {
+                    "unlimited_gifts": False,
+                    "limited_gifts": False,
+                    "unique_gifts": False,
+                    "premium_subscription": False,
+                    "gifts_from_channels": False,
+                },
+            }
+            return {**make_chat(int(params["chat_id"])), **full_info}
+        if method == "getChatMemberCount":
+            return 42
+        if method == "getChatMember":
+            return {"status": "member", "user": BOT_USER}
+        if method == "getChatAdministrators":
+            return []
+        if method == "getUpdates":
+            return []
+        return True  # deleteMessage(s), setWebhook, deleteWebhook and the rest
+
+
+# Deliver one update to a webhook URL the way Telegram does and return the HTTP status
+async def post_update(url, update, secret_token=None):
+    host_port, _, path = url.removeprefix("http://").partition("/")
+    host, _, port = host_port.partition(":")
+    body = json.dumps(update).encode()
+    headers = f"POST /{path} HTTP/1.1\r\nHost: {host_port}\r\nContent-Type: application/json\r\n"
+    if secret_token:
+        headers += f"{SECRET_HEADER}: {secret_token}\r\n"
+    headers += f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+
+    reader, writer = await asyncio.open_connection(host, int(port or 80))
+    writer.write(headers.encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+# Synthetic updates
+
+update_ids = itertools.count(1)
+
+
+def make_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+
+def make_chat(chat_id):
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+    return {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"}
+
+
+def make_message_update(chat_id, user_id, message_id, text="hello", edited=False, photo=False):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": make_chat(chat_id),
+        "from": make_user(user_id),
+    }
+    if photo:
+        message["photo"] = [{"file_id": f"photo{message_id}", "file_unique_id": f"u{message_id}",
+                             "width": 1280, "height": 720}]
+        message["caption"] = text
+    else:
+        message["text"] = text
+    if text.startswith("/") and not photo:
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if edited:
+        message["edit_date"] = int(time.time())
+        return {"update_id": next(update_ids), "edited_message": message}
+    return {"update_id": next(update_ids), "message": message}
+
+
+# Endless stream of group traffic: new messages, edits of earlier messages and photos
+def synthetic_updates(groups=10, users_per_group=20, edit_ratio=0.1, media_ratio=0.2, seed=1):
+    rng = random.Random(seed)
+    chat_ids = [-1001000000000 - i for i in range(groups)]
+    last_message_ids = dict.fromkeys(chat_ids, 0)
+    while True:
+        chat_id = rng.choice(chat_ids)
+        user_id = 10_000 + rng.randrange(users_per_group)
+        if last_message_ids[chat_id] and rng.random() < edit_ratio:
+            message_id = rng.randint(1, last_message_ids[chat_id])
+            yield make_message_update(chat_id, user_id, message_id, "edited", edited=True)
+            continue
+        last_message_ids[chat_id] += 1
+        yield make_message_update(chat_id, user_id, last_message_ids[chat_id],
+                                  photo=rng.random() < media_ratio)
+
+
+# Start the bot in webhook mode against fake, with its data files in the working
+# directory. Returns the bot module, the webhook URL and a coroutine function
+# that stops the bot.
+async def start_bot(fake, shards=1):
+    os.environ["BOT_API_URL"] = fake.base_url  # Shard processes read it at import
+    import Copyrightsaver_bot as bot_module
+
+    bot_module.BOT_API_URL = fake.base_url
+    bot_module.WEBHOOK_LISTEN = "127.0.0.1"
+    bot_module.WEBHOOK_PORT = 0
+    bot_module.WEBHOOK_SECRET = SECRET_TOKEN
+    bot_module.WEBHOOK_SHARDS = shards
+    serve = bot_module.serve_sharded if shards > 1 else bot_module.serve_webhook
+    stop = asyncio.Event()
+    ready = asyncio.Event()
+    servers = []
+    bot_task = asyncio.create_task(serve(stop, ready, servers))
+    await ready.wait()
+
+    async def stop_bot():
+        stop.set()
+        await bot_task
+
+    return bot_module, f"http://127.0.0.1:{servers[0].port}{bot_module.WEBHOOK_PATH}", stop_bot
+
+
+async def self_check(shards=1):
+    fake = FakeTelegram()
+    await fake.start()
+
+    # The bot reads and writes its data files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="fake_telegram_"))
+    import Copyrightsaver_bot as bot_module
+
+    bot_module.log_pipeline.start()
+    bot_module, url, stop_bot = await start_bot(fake, shards)
+
+    owner_id = int(bot_module.OWNER_ID)
+    updates = [
+        make_message_update(-100123, 42, 1, "/start"),
+        make_message_update(-100123, 42, 2, "hello"),
+        make_message_update(-100123, 42, 2, "hello again", edited=True),
+        make_message_update(-100124, 43, 1, "/start"),
+        make_message_update(-100125, 44, 1, "/start"),
+    ]
+    for update in updates:
+        print(f"Posted update {update['update_id']}: HTTP {await post_update(url, update, SECRET_TOKEN)}")
+    print(f"Posted update with a wrong secret: HTTP {await post_update(url, updates[1], 'wrong')}")
+
+    # Owner commands are answered across every shard
+    await asyncio.sleep(3 if shards > 1 else 0.5)
+    await post_update(url, make_message_update(owner_id, owner_id, 1, "/countuser"), SECRET_TOKEN)
+    await asyncio.sleep(1)
+    await stop_bot()
+    await fake.stop()
+
+    print("\nBot API calls:")
+    for _, method, params in fake.calls:
+        print(f"  {method} {params}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Run the bot against the fake Bot API.")
+    parser.add_argument("--shards", type=int, default=1, help="Shard processes, 1 for a single process")
+    asyncio.run(self_check(parser.parse_args().shards))
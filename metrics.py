@@ -0,0 +1,193 @@
+import asyncio
+import time
+from bisect import bisect_left
+
+from webhook_server import read_http_request, write_http_response
+
+# Metrics in the Prometheus text format.
+# Counters and histograms keep one entry per label tuple in a plain dict, so
+# recording on the hot path is a dict lookup and an add. CallbackMetric reads
+# numbers the bot already keeps (queue lengths, existing counters) only when
+# the metrics are rendered. MetricsServer serves GET /metrics for scraping.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> count
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield "", tuple(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label values -> [bucket counts..., +Inf count, sum, max]
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        if value > entry[-1]:
+            entry[-1] = value
+
+    def samples(self):
+        for label_values, entry in self.values.items():
+            labels = tuple(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), entry):
+                cumulative += count
+                yield "_bucket", labels + (("le", format_value(bound)),), cumulative
+            yield "_sum", labels, entry[-2]
+            yield "_count", labels, cumulative
+
+    # Summaries for /stats, across every label tuple unless label values are given
+    def merged(self, *label_values):
+        if label_values:
+            entries = [self.values[label_values]] if label_values in self.values else []
+        else:
+            entries = list(self.values.values())
+        if not entries:
+            return None
+        return [sum(column) for column in zip(*entries)][:-1] + [max(entry[-1] for entry in entries)]
+
+    def count(self, *label_values):
+        entry = self.merged(*label_values)
+        return sum(entry[:-2]) if entry else 0
+
+    def max(self, *label_values):
+        entry = self.merged(*label_values)
+        return entry[-1] if entry else 0.0
+
+    # Upper bound of the bucket holding the q-th quantile
+    def quantile(self, q, *label_values):
+        entry = self.merged(*label_values)
+        if not entry:
+            return 0.0
+        counts = entry[:-2]
+        target = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip((*self.buckets, entry[-1]), counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, entry[-1])
+        return entry[-1]
+
+
+class CallbackMetric:
+    def __init__(self, name, help, type, callback, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.type = type  # "gauge" or "counter"
+        self.labels = labels
+        self.callback = callback  # Returns a number, or a dict of label values -> number
+        registry.register(self)
+
+    def samples(self):
+        value = self.callback()
+        if not isinstance(value, dict):
+            yield "", (), value
+            return
+        for label_values, number in value.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield "", tuple(zip(self.labels, label_values)), number
+
+
+# Sample how late the event loop wakes up from a sleep of interval seconds
+async def monitor_loop_lag(histogram, interval=0.5):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(time.perf_counter() - started - interval, 0.0))
+
+
+class MetricsServer:
+    def __init__(self, listen, port, registry=REGISTRY):
+        self.listen = listen
+        self.port = port
+        self.registry = registry
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await read_http_request(reader)
+            if request is None:
+                return
+            method, path, _, _ = request
+            if method != "GET" or path.split("?", 1)[0] != "/metrics":
+                write_http_response(writer, 404)
+            else:
+                write_http_response(writer, 200, self.registry.render().encode(), CONTENT_TYPE)
+            await writer.drain()
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,256 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import RetryAfter
+
+# Outbound request queue
+# Bot API calls that can pile up go through one OutboundQueue: edit
+# announcements, deletions, broadcast sends and background reads. Requests wait
+# in a queue per chat and per priority: deletions first, then sends, then
+# broadcasts, then reads. Deletions and reads aren't spaced per chat. Within
+# a priority, chats take turns one request at a time, so a noisy group only
+# delays itself. A token bucket keeps the whole bot under Telegram's global
+# limit and sends to one chat are spaced to its per-chat limit. RetryAfter
+# pauses only the chat that got it and widens its spacing until sends
+# succeed again.
+
+DELETE, SEND, BULK, READ = 0, 1, 2, 3  # Priorities, the lowest value is served first
+SPACED = (SEND, BULK)  # Priorities held to the per-chat send interval
+OUTBOUND_RATE = 25  # Requests per second, below Telegram's global limit of 30
+OUTBOUND_CONCURRENCY = 20  # Requests in flight at once
+GROUP_SEND_INTERVAL = 3.0  # Seconds between sends to one group, Telegram allows 20 per minute
+PRIVATE_SEND_INTERVAL = 1.0  # Seconds between sends to one private chat
+MAX_SEND_INTERVAL = 60.0  # Upper bound for spacing widened after RetryAfter
+SEND_QUEUE_LIMIT = 20  # Sends waiting per chat before new ones are dropped
+PRUNE_INTERVAL = 60  # Seconds between sweeps of idle per-chat state
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Stop handing out tokens, e.g. after Telegram answers with RetryAfter
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class ChatState:
+    __slots__ = ("base_interval", "interval", "next_send", "paused_until", "busy")
+
+    def __init__(self, chat_id):
+        self.base_interval = GROUP_SEND_INTERVAL if chat_id < 0 else PRIVATE_SEND_INTERVAL
+        self.interval = self.base_interval
+        self.next_send = 0.0  # Sends are held until then, deletions are not
+        self.paused_until = 0.0  # Nothing goes to the chat until then
+        self.busy = False  # A request for the chat is in flight
+
+    def idle(self, now):
+        return (not self.busy and self.interval == self.base_interval
+                and self.next_send <= now and self.paused_until <= now)
+
+
+class OutboundQueue:
+    def __init__(self, rate=OUTBOUND_RATE, concurrency=OUTBOUND_CONCURRENCY):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        # One OrderedDict per priority: chat_id -> deque of (call, future, retry), in turn order
+        self.queues = [OrderedDict() for _ in (DELETE, SEND, BULK, READ)]
+        self.chats = {}  # chat_id -> ChatState
+        self.wakeup = asyncio.Event()
+        self.slots = None
+        self.task = None
+        self.in_flight = set()
+        self.last_prune = time.monotonic()
+        self.metrics = {
+            "completed": 0,  # Calls that returned
+            "failed": 0,  # Calls that raised
+            "retried": 0,  # Calls put back after RetryAfter
+            "dropped": 0,  # Sends refused because the chat's queue was full
+            "rate_limited": 0,  # RetryAfter answers
+        }
+
+    # Queue a call and return a future for its result. call is a coroutine
+    # function. With retry, RetryAfter puts the call back in line, otherwise
+    # the caller gets the RetryAfter.
+    def enqueue(self, chat_id, priority, call, retry=True):
+        future = asyncio.get_running_loop().create_future()
+        queues = self.queues[priority]
+        queue = queues.get(chat_id)
+        if queue is None:
+            queue = queues[chat_id] = deque()
+        elif priority != DELETE and len(queue) >= SEND_QUEUE_LIMIT:
+            self.metrics["dropped"] += 1
+            future.set_exception(asyncio.QueueFull(f"Too many requests queued for chat {chat_id}"))
+            return future
+        queue.append((call, future, retry))
+        self.wakeup.set()
+        return future
+
+    async def submit(self, chat_id, priority, call, retry=True):
+        return await self.enqueue(chat_id, priority, call, retry)
+
+    def chat_state(self, chat_id):
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = ChatState(chat_id)
+        return state
+
+    def ready(self, state, priority, now):
+        if state.busy or state.paused_until > now:
+            return False
+        return priority not in SPACED or state.next_send <= now
+
+    # Take the next request from the first chat, in turn order, that may be sent to now
+    def pop_ready(self, now):
+        for priority, queues in enumerate(self.queues):
+            for chat_id, queue in queues.items():
+                if not self.ready(self.chat_state(chat_id), priority, now):
+                    continue
+                request = queue.popleft()
+                if queue:
+                    queues.move_to_end(chat_id)  # Back of the line for this chat
+                else:
+                    del queues[chat_id]
+                return chat_id, priority, request
+        return None
+
+    # Seconds until a paused or spaced-out chat can be served again
+    def next_ready_in(self, now):
+        times = []
+        for priority, queues in enumerate(self.queues):
+            for chat_id in queues:
+                state = self.chat_state(chat_id)
+                if not state.busy:
+                    times.append(max(state.paused_until, state.next_send if priority in SPACED else 0))
+        return max(min(times) - now, 0) if times else None
+
+    def prune(self, now):
+        queued = set()
+        for queues in self.queues:
+            queued.update(queues)
+        for chat_id in [chat_id for chat_id, state in self.chats.items() if state.idle(now)]:
+            if chat_id not in queued:
+                del self.chats[chat_id]
+        self.last_prune = now
+
+    def back_off(self, chat_id, priority, retry_after):
+        self.metrics["rate_limited"] += 1
+        state = self.chat_state(chat_id)
+        state.paused_until = max(state.paused_until, time.monotonic() + retry_after)
+        if priority in SPACED:
+            # The refused send didn't count, the retry may go as soon as the pause ends
+            state.next_send = state.paused_until
+            state.interval = min(MAX_SEND_INTERVAL, state.interval * 2)
+        if priority in (BULK, READ):
+            # Broadcasts send one message per chat and reads have no per-chat limit,
+            # so RetryAfter there means the global limit
+            self.bucket.pause(retry_after)
+
+    async def execute(self, chat_id, priority, request):
+        call, future, retry = request
+        state = self.chat_state(chat_id)
+        try:
+            result = await call()
+        except RetryAfter as e:
+            self.back_off(chat_id, priority, e.retry_after)
+            if retry and not future.done():
+                self.metrics["retried"] += 1
+                self.queues[priority].setdefault(chat_id, deque()).appendleft(request)
+            elif not future.done():
+                future.set_exception(e)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.metrics["failed"] += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.metrics["completed"] += 1
+            if priority in SPACED:
+                state.interval = max(state.base_interval, state.interval / 2)
+            if not future.done():
+                future.set_result(result)
+        finally:
+            state.busy = False
+            self.slots.release()
+            self.wakeup.set()
+
+    async def run(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await self.slots.acquire()
+            await self.bucket.acquire()
+            while True:
+                now = time.monotonic()
+                if now - self.last_prune >= PRUNE_INTERVAL:
+                    self.prune(now)
+                picked = self.pop_ready(now)
+                if picked is not None:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.next_ready_in(now))
+                except asyncio.TimeoutError:
+                    pass
+
+            chat_id, priority, request = picked
+            if request[1].done():  # The caller gave up on it
+                self.slots.release()
+                continue
+            state = self.chat_state(chat_id)
+            state.busy = True
+            if priority in SPACED:
+                state.next_send = now + state.interval
+            task = asyncio.create_task(self.execute(chat_id, priority, request))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    def start(self):
+        # Start with an empty bucket so a restart with a backlog ramps up instead of bursting
+        self.bucket.tokens = 0
+        self.bucket.updated = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+
+    # Wait until nothing is queued or in flight. Returns False if timeout seconds pass first.
+    async def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while any(self.queued()) or self.in_flight:
+            if self.task is None or time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def stop(self):
+        tasks = [self.task, *self.in_flight] if self.task else list(self.in_flight)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+        for queues in self.queues:
+            for queue in queues.values():
+                for _, future, _ in queue:
+                    future.cancel()
+            queues.clear()
+
+    def queued(self):
+        return [sum(map(len, queues.values())) for queues in self.queues]
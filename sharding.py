@@ -0,0 +1,144 @@
+import asyncio
+import itertools
+import queue
+
+# Chat-ID sharding
+# In sharded mode the webhook process is a coordinator. It sends every update
+# to the shard process that owns the update's chat (chat_id % shards) over
+# that shard's multiprocessing queue, so each shard only ever sees its own
+# chats. Queries fan out to every shard and the answers come back on one
+# shared reply queue. A shard that needs another chat's shard to do something,
+# e.g. record a user who sent /start in a group, forwards the call through the
+# coordinator.
+
+QUERY_TIMEOUT = 10  # Seconds to wait for every shard to answer a query
+FORWARD_RETRY_DELAY = 0.5  # Seconds before a forwarded call is offered to a full inbox again
+
+# Update fields that carry the chat the update belongs to
+CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+               "my_chat_member", "chat_member", "chat_join_request")
+
+
+def shard_of(chat_id, shards):
+    return int(chat_id) % shards
+
+
+def update_chat_id(update):
+    for field in CHAT_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    message = (update.get("callback_query") or {}).get("message")
+    if message:
+        return message["chat"]["id"]
+    return 0  # Updates without a chat go to shard 0
+
+
+class Coordinator:
+    def __init__(self, inboxes, outbox):
+        self.inboxes = inboxes  # One multiprocessing queue per shard
+        self.outbox = outbox  # Shared queue for replies and forwarded calls
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request_id -> (future, results, shards that answered)
+        self.retries = set()  # Forwarded calls waiting for room in a shard's inbox
+        self.task = None
+
+    # Raises queue.Full when the shard is behind
+    def send_update(self, update, body):
+        shard = shard_of(update_chat_id(update), len(self.inboxes))
+        self.inboxes[shard].put_nowait(("update", body))
+        return shard
+
+    # Run a query on every shard and return the answers in shard order. The
+    # inboxes are bounded, a shard that is behind fails the query instead of
+    # blocking the event loop.
+    async def query(self, name, *args):
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (future, [None] * len(self.inboxes), set())
+        try:
+            for shard, inbox in enumerate(self.inboxes):
+                try:
+                    inbox.put_nowait(("query", request_id, name, args))
+                except queue.Full:
+                    raise RuntimeError(f"Shard {shard} is too far behind to answer") from None
+            return await asyncio.wait_for(future, QUERY_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def on_reply(self, request_id, shard, result, error=None):
+        entry = self.pending.get(request_id)
+        if entry is None:  # The query already timed out
+            return
+        future, results, answered = entry
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(f"Shard {shard} failed: {error}"))
+            return
+        results[shard] = result
+        answered.add(shard)
+        if len(answered) == len(results):
+            future.set_result(results)
+
+    async def relay(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.outbox.get)
+            if message is None:
+                break
+            kind, *args = message
+            if kind == "reply":
+                self.on_reply(*args)
+            elif kind == "failed":
+                request_id, shard, error = args
+                self.on_reply(request_id, shard, None, error)
+            elif kind == "forward":
+                chat_id, name, call_args = args
+                self.deliver(self.inboxes[shard_of(chat_id, len(self.inboxes))], ("call", name, call_args))
+
+    # Forwarded calls change state, so they wait for room rather than being dropped
+    def deliver(self, inbox, message):
+        try:
+            inbox.put_nowait(message)
+        except queue.Full:
+            task = asyncio.create_task(self.deliver_later(inbox, message))
+            self.retries.add(task)
+            task.add_done_callback(self.retries.discard)
+
+    async def deliver_later(self, inbox, message):
+        while True:
+            await asyncio.sleep(FORWARD_RETRY_DELAY)
+            try:
+                inbox.put_nowait(message)
+                return
+            except queue.Full:
+                pass
+
+    def start(self):
+        self.task = asyncio.create_task(self.relay())
+
+    async def stop(self):
+        self.outbox.put(None)  # Wakes the relay's blocking get
+        await self.task
+        for task in list(self.retries):
+            task.cancel()
+
+
+# A shard's side of the queues
+class ShardLink:
+    def __init__(self, shard, shards, outbox):
+        self.shard = shard
+        self.shards = shards
+        self.outbox = outbox
+
+    def owns(self, chat_id):
+        return shard_of(chat_id, self.shards) == self.shard
+
+    def forward(self, chat_id, name, *args):
+        self.outbox.put(("forward", chat_id, name, args))
+
+    def reply(self, request_id, result):
+        self.outbox.put(("reply", request_id, self.shard, result))
+
+    def fail(self, request_id, error):
+        self.outbox.put(("failed", request_id, self.shard, str(error)))
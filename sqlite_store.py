@@ -0,0 +1,270 @@
+import sqlite3
+from collections import OrderedDict
+from itertools import groupby
+
+# SQLite state store used when STORAGE_BACKEND is "sqlite".
+# Every table is keyed by its ID column, so membership checks are index
+# lookups and counts never load rows into Python. sqlite3 keeps compiled
+# statements in its statement cache, so the constant SQL strings below are
+# prepared once per connection.
+#
+# Several processes may share one file (webhook workers). poll_changes() tells
+# a process that another one committed, and the config version, bumped by every
+# settings and authorization change, tells it when its preloaded copies are stale.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS started_users (user_id INTEGER PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS group_ids (chat_id INTEGER PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS global_authorized_users (user_id INTEGER PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS group_authorized_users (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS group_settings (
+    chat_id INTEGER PRIMARY KEY,
+    delete_timer INTEGER NOT NULL,
+    auto_delete INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_chats (
+    chat_id INTEGER PRIMARY KEY,
+    reason TEXT NOT NULL,
+    was_user INTEGER NOT NULL,
+    was_group INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+"""
+
+CACHE_SIZE = 4096  # Entries kept in the read-through cache
+
+
+class SQLiteStore:
+    def __init__(self, path, cache_size=CACHE_SIZE):
+        self.conn = sqlite3.connect(path, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.config_seen = None
+
+    def close(self):
+        self.conn.close()
+
+    # Read-through cache
+
+    def _cached(self, key, load):
+        try:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        except KeyError:
+            pass
+        value = load()
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)  # Evict the least recently used entry
+        return value
+
+    def _invalidate(self, key):
+        self.cache.pop(key, None)
+
+    # Changes made by other processes
+
+    # True when another connection committed since the last call, cached reads are dropped then
+    def poll_changes(self):
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return False
+        self.data_version = version
+        self.cache.clear()
+        return True
+
+    # True when settings or authorizations changed since the last call, the first call is always True
+    def config_changed(self):
+        row = self.conn.execute("SELECT version FROM versions WHERE name = 'config'").fetchone()
+        version = row[0] if row else 0
+        if version == self.config_seen:
+            return False
+        self.config_seen = version
+        return True
+
+    # Call inside the transaction that changes settings or authorizations
+    def _bump_config(self):
+        self.conn.execute(
+            "INSERT INTO versions VALUES ('config', 1) ON CONFLICT(name) DO UPDATE SET version = version + 1"
+        )
+
+    def _exists(self, sql, params):
+        return self.conn.execute(sql, params).fetchone() is not None
+
+    def _insert(self, sql, params):
+        with self.conn:
+            return self.conn.execute(sql, params).rowcount > 0
+
+    # Users and groups
+
+    def add_started_user(self, user_id):
+        return self._insert("INSERT OR IGNORE INTO started_users VALUES (?)", (user_id,))
+
+    def add_group(self, chat_id):
+        return self._insert("INSERT OR IGNORE INTO group_ids VALUES (?)", (chat_id,))
+
+    def count_started_users(self):
+        return self.conn.execute("SELECT COUNT(*) FROM started_users").fetchone()[0]
+
+    def count_groups(self):
+        # Group and supergroup IDs are negative, private chats are positive
+        return self.conn.execute("SELECT COUNT(*) FROM group_ids WHERE chat_id < 0").fetchone()[0]
+
+    def iter_groups(self):
+        cursor = self.conn.execute("SELECT chat_id FROM group_ids WHERE chat_id < 0")
+        for (chat_id,) in cursor:
+            yield chat_id
+
+    def iter_recipients(self):
+        cursor = self.conn.execute("SELECT user_id FROM started_users UNION SELECT chat_id FROM group_ids")
+        for (chat_id,) in cursor:
+            yield chat_id
+
+    # Authorizations
+
+    # Authorizations are preloaded into the bot's AuthIndex, so these only write
+
+    def iter_global_auth(self):
+        for (user_id,) in self.conn.execute("SELECT user_id FROM global_authorized_users"):
+            yield user_id
+
+    def iter_group_auth(self):
+        cursor = self.conn.execute("SELECT chat_id, user_id FROM group_authorized_users ORDER BY chat_id")
+        for chat_id, rows in groupby(cursor, key=lambda row: row[0]):
+            yield chat_id, [user_id for _, user_id in rows]
+
+    def authorize_global(self, user_id):
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO global_authorized_users VALUES (?)", (user_id,))
+            self._bump_config()
+
+    def unauthorize_global(self, user_id):
+        with self.conn:
+            self._bump_config()
+            return self.conn.execute(
+                "DELETE FROM global_authorized_users WHERE user_id = ?", (user_id,)
+            ).rowcount > 0
+
+    def authorize_in_group(self, chat_id, user_id):
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO group_authorized_users VALUES (?, ?)", (chat_id, user_id))
+            self._bump_config()
+
+    # Group settings
+
+    # Settings are few, so the bot preloads all of them instead of caching lookups
+    def iter_group_configs(self):
+        cursor = self.conn.execute("SELECT chat_id, delete_timer, auto_delete FROM group_settings")
+        for chat_id, delete_timer, auto_delete in cursor:
+            yield chat_id, {"delete_timer": delete_timer, "auto_delete": bool(auto_delete)}
+
+    def set_group_config(self, chat_id, config):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO group_settings VALUES (?, ?, ?)",
+                (chat_id, config["delete_timer"], int(config["auto_delete"])),
+            )
+            self._bump_config()
+
+    # Dead recipients
+
+    def is_dead(self, chat_id):
+        return self._cached(
+            ("dead", chat_id),
+            lambda: self._exists("SELECT 1 FROM dead_chats WHERE chat_id = ?", (chat_id,)),
+        )
+
+    def mark_dead(self, chat_id, reason):
+        self._invalidate(("dead", chat_id))
+        with self.conn:
+            if self._exists("SELECT 1 FROM dead_chats WHERE chat_id = ?", (chat_id,)):
+                return False  # Already dead, keep what it was
+            was_user = self.conn.execute("DELETE FROM started_users WHERE user_id = ?", (chat_id,)).rowcount
+            was_group = self.conn.execute("DELETE FROM group_ids WHERE chat_id = ?", (chat_id,)).rowcount
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dead_chats VALUES (?, ?, ?, ?)",
+                (chat_id, reason, was_user, was_group),
+            )
+        return True
+
+    def reactivate(self, chat_id):
+        self._invalidate(("dead", chat_id))
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT was_user, was_group FROM dead_chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            if row[0]:
+                self.conn.execute("INSERT OR IGNORE INTO started_users VALUES (?)", (chat_id,))
+            if row[1]:
+                self.conn.execute("INSERT OR IGNORE INTO group_ids VALUES (?)", (chat_id,))
+            self.conn.execute("DELETE FROM dead_chats WHERE chat_id = ?", (chat_id,))
+        return True
+
+    def count_dead(self):
+        return self.conn.execute("SELECT COUNT(*) FROM dead_chats").fetchone()[0]
+
+    # One-time import of an existing data.json
+
+    def is_empty(self):
+        return not self._exists("SELECT 1 FROM started_users UNION ALL SELECT 1 FROM group_ids LIMIT 1", ())
+
+    def import_data(self, data):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO started_users VALUES (?)",
+                ((int(u),) for u in data.get("started_users", [])),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO group_ids VALUES (?)",
+                ((int(c),) for c in data.get("group_ids", [])),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO global_authorized_users VALUES (?)",
+                ((int(u),) for u in data.get("global_authorized_users", [])),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO group_authorized_users VALUES (?, ?)",
+                (
+                    (int(chat_id), int(user_id))
+                    for chat_id, users in data.get("group_authorized_users", {}).items()
+                    for user_id in users
+                ),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO group_settings VALUES (?, ?, ?)",
+                (
+                    (int(chat_id), config.get("delete_timer", 30 * 60), int(config.get("auto_delete", True)))
+                    for chat_id, config in data.get("group_settings", {}).items()
+                ),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dead_chats VALUES (?, ?, ?, ?)",
+                (
+                    (int(chat_id), reason, int(was_user), int(was_group))
+                    for chat_id, (reason, was_user, was_group) in data.get("dead_chats", {}).items()
+                ),
+            )
+        self.cache.clear()
+
+    # The whole store in the data.json format, e.g. to split it between shards
+    def export_data(self):
+        return {
+            "started_users": [user_id for (user_id,) in self.conn.execute("SELECT user_id FROM started_users")],
+            "group_ids": [chat_id for (chat_id,) in self.conn.execute("SELECT chat_id FROM group_ids")],
+            "global_authorized_users": list(self.iter_global_auth()),
+            "group_authorized_users": dict(self.iter_group_auth()),
+            "group_settings": dict(self.iter_group_configs()),
+            "dead_chats": {
+                chat_id: [reason, bool(was_user), bool(was_group)]
+                for chat_id, reason, was_user, was_group in self.conn.execute("SELECT * FROM dead_chats")
+            },
+        }
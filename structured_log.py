@@ -0,0 +1,128 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured logging
+# A log call on the event loop only puts the record on a bounded queue. A
+# writer thread turns each record into one JSON line and writes it, so slow
+# stdout never stalls update processing. When the writer falls behind, new
+# records are dropped and counted rather than waited on. Repetitive messages
+# are rate limited per message template: the first LOG_BURST records of a
+# template in each LOG_WINDOW go through, the rest are counted and the count
+# rides along on the next record that goes through. Fields passed with
+# extra=, e.g. chat_id and message_id, become keys of the JSON record.
+
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread before new ones are dropped
+LOG_BURST = 5  # Records per message template per window
+LOG_WINDOW = 60.0  # Seconds
+
+# Attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, fields=None):
+        super().__init__()
+        self.fields = fields or {}  # Added to every record, e.g. the shard
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **self.fields,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, burst=LOG_BURST, window=LOG_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.windows = {}  # (logger, template) -> [window start, records let through, records held back]
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        state = self.windows.get(key)
+        if state is None or record.created - state[0] >= self.window:
+            if state is not None and state[2]:
+                record.suppressed = state[2]  # Held back in the previous window
+            state = self.windows[key] = [record.created, 0, 0]
+        if state[1] >= self.burst:
+            state[2] += 1
+            self.suppressed += 1
+            return False
+        state[1] += 1
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # Only render what can't safely cross threads, the JSON is built by the writer thread
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogPipeline:
+    def __init__(self, logger, level="INFO", stream=None, fields=None):
+        self.logger = logger
+        self.level = level
+        self.rate_limit = RateLimitFilter()
+        self.handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self.handler.addFilter(self.rate_limit)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter(fields))
+        self.listener = QueueListener(self.handler.queue, output)
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.logger.setLevel(self.level)
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+        self.listener.start()
+        self.started = True
+        atexit.register(self.stop)  # Write out what is still queued
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    @property
+    def suppressed(self):
+        return self.rate_limit.suppressed
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import Copyrightsaver_bot as bot
+
+
+class AdminBot:
+    def __init__(self, admins=(1, 2), delay=0):
+        self.admins = admins
+        self.delay = delay
+        self.calls = []
+
+    async def get_chat_administrators(self, chat_id):
+        self.calls.append(chat_id)
+        await asyncio.sleep(self.delay)
+        return [SimpleNamespace(user=SimpleNamespace(id=user_id)) for user_id in self.admins]
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(bot, "admin_cache", OrderedDict())
+    monkeypatch.setattr(bot, "admin_lookups", {})
+
+
+def test_admins_are_cached_until_the_ttl():
+    admin_bot = AdminBot()
+
+    async def main():
+        assert await bot.is_admin_or_owner(1, -100, admin_bot)
+        assert not await bot.is_admin_or_owner(3, -100, admin_bot)
+        expires_at, admin_ids = bot.admin_cache[-100]
+        assert expires_at - time.monotonic() == pytest.approx(bot.ADMIN_CACHE_TTL, abs=1)
+        assert admin_bot.calls == [-100]
+
+        bot.admin_cache[-100] = (time.monotonic() - 1, admin_ids)  # Expired
+        await bot.get_admin_ids(-100, admin_bot)
+        assert admin_bot.calls == [-100, -100]
+
+    asyncio.run(main())
+
+
+def test_owner_needs_no_lookup():
+    admin_bot = AdminBot()
+    assert asyncio.run(bot.is_admin_or_owner(int(bot.OWNER_ID), -100, admin_bot))
+    assert admin_bot.calls == []
+
+
+def test_least_recently_used_chat_is_evicted(monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_CACHE_SIZE", 2)
+    admin_bot = AdminBot()
+
+    async def main():
+        for chat_id in (-1, -2, -1, -3):  # -1 is used again, so -2 is the one to go
+            await bot.get_admin_ids(chat_id, admin_bot)
+
+    asyncio.run(main())
+    assert list(bot.admin_cache) == [-1, -3]
+    assert admin_bot.calls == [-1, -2, -3]
+
+
+def test_concurrent_lookups_share_one_call():
+    admin_bot = AdminBot(delay=0.05)
+
+    async def main():
+        return await asyncio.gather(*(bot.get_admin_ids(-100, admin_bot) for _ in range(10)))
+
+    assert all(admin_ids == {1, 2} for admin_ids in asyncio.run(main()))
+    assert admin_bot.calls == [-100]
+    assert not bot.admin_lookups
+
+
+def test_promotion_invalidates_the_chat():
+    admin_bot = AdminBot()
+    asyncio.run(bot.get_admin_ids(-100, admin_bot))
+    bot.invalidate_admins(-100)
+    asyncio.run(bot.get_admin_ids(-100, admin_bot))
+    assert admin_bot.calls == [-100, -100]
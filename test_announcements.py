@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+
+import Copyrightsaver_bot as bot
+from outbound_queue import OutboundQueue
+
+
+def editors(*counts):
+    return {user_id: [f"user{user_id}", edits] for user_id, edits in enumerate(counts, 1)}
+
+
+def test_single_edit_keeps_the_original_wording():
+    text = bot.edit_announcement(editors(1))
+    assert "user1" in text and "user1 (" not in text
+
+
+def test_counts_are_shown_per_editor_and_in_total():
+    text = bot.edit_announcement(editors(3, 1))
+    assert "user1 (3), user2 " in text
+    assert "4 𝘮𝘦𝘴𝘴𝘢𝘨𝘦𝘴" in text
+
+
+def test_editors_past_the_limit_are_counted():
+    text = bot.edit_announcement(editors(*[1] * (bot.EDIT_ANNOUNCE_MAX_USERS + 5)))
+    assert f"user{bot.EDIT_ANNOUNCE_MAX_USERS}, 5 𝘮𝘰𝘳𝘦" in text
+    assert f"user{bot.EDIT_ANNOUNCE_MAX_USERS + 1}" not in text
+    assert f"{bot.EDIT_ANNOUNCE_MAX_USERS + 5} 𝘮𝘦𝘴𝘴𝘢𝘨𝘦𝘴" in text
+
+
+class SendingBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode):
+        self.sent.append((chat_id, text))
+
+
+def test_edits_in_one_window_share_one_announcement(monkeypatch):
+    monkeypatch.setattr(bot, "EDIT_ANNOUNCE_WINDOW", 0.05)
+    monkeypatch.setattr(bot, "outbound", OutboundQueue(rate=1000))
+    sending_bot = SendingBot()
+
+    def user(user_id):
+        return SimpleNamespace(id=user_id, mention_html=lambda: f"user{user_id}")
+
+    async def main():
+        bot.outbound.start()
+        for user_id in (1, 2, 1, 1):
+            bot.note_edit(sending_bot, -100, user(user_id))
+        bot.note_edit(sending_bot, -200, user(3))
+        await asyncio.sleep(0.2)
+        await bot.outbound.stop()
+
+    asyncio.run(main())
+    assert sorted(chat_id for chat_id, _ in sending_bot.sent) == [-200, -100]
+    [text] = [text for chat_id, text in sending_bot.sent if chat_id == -100]
+    assert "user1 (3), user2 " in text and "4 𝘮𝘦𝘴𝘴𝘢𝘨𝘦𝘴" in text
+    assert not bot.pending_edits
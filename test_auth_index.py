@@ -0,0 +1,40 @@
+import pytest
+
+from auth_index import AuthIndex, BLOOM_REBUILD_AFTER
+
+
+@pytest.mark.parametrize("bloom_bits, compact_after, compact", [(0, 100, False), (0, 0, True), (1 << 16, 0, True)])
+def test_auth_index(bloom_bits, compact_after, compact):
+    index = AuthIndex(bloom_bits, compact_after)
+    index.build(["7", 8], [("-100", ["9"]), (-200, [10, 10])])
+    assert index.compact == compact
+
+    assert index.is_exempt(-300, 7) and index.is_exempt(-300, 8)
+    assert index.is_exempt(-100, 9) and not index.is_exempt(-200, 9)
+    assert index.chat_lists() == {-100: [9], -200: [10]}
+    assert not index.is_exempt(-100, 11)
+
+    assert index.discard_global(7) and not index.discard_global(7)
+    assert not index.is_exempt(-300, 7)
+    assert index.add_in_chat(-300, 7) and not index.add_in_chat(-300, 7)
+    assert index.is_exempt(-300, 7) and not index.is_exempt(-100, 7)
+
+
+def test_auth_index_rebuilds_bloom_filter_after_removals():
+    index = AuthIndex(1 << 16, compact_after=0)
+    index.build(range(BLOOM_REBUILD_AFTER + 1), [])
+    for user_id in range(BLOOM_REBUILD_AFTER):
+        index.discard_global(user_id)
+
+    assert index.removals == 0
+    assert index.global_list() == [BLOOM_REBUILD_AFTER]
+    assert not any(index.is_exempt(-100, user_id) for user_id in range(BLOOM_REBUILD_AFTER))
+
+
+def test_layout_follows_the_number_of_ids():
+    index = AuthIndex(compact_after=3)
+    index.build([1, 2], [(-100, [3])])
+    assert not index.compact and isinstance(index.global_ids, set)
+    index.build([1, 2], [(-100, [3, 4])])
+    assert index.compact and index.bloom is not None
+    assert index.global_list() == [1, 2] and index.chat_lists() == {-100: [3, 4]}
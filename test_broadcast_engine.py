@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import broadcast_engine
+from broadcast_engine import Broadcast
+
+
+class CopyingBot:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.sent = []
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        self.sent.append(chat_id)
+        await asyncio.sleep(0)
+        if chat_id in self.fail:
+            raise RuntimeError("Forbidden")
+
+
+# Sends straight away, the pacing is the outbound queue's business
+class DirectOutbound:
+    async def submit(self, chat_id, priority, call):
+        return await call()
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+def test_broadcast_resumes_without_resending():
+    copying_bot = CopyingBot()
+    broadcast = Broadcast(copying_bot, DirectOutbound(), 1, 2, list(range(100, 110)), 1,
+                          position=3, done_after=[5, 7], sent=5)
+    asyncio.run(broadcast.run())
+
+    assert sorted(copying_bot.sent) == [103, 104, 106, 108, 109]
+    assert broadcast.finished and broadcast.sent == 10
+    assert Broadcast.load(copying_bot, DirectOutbound()) is None  # Finished jobs are cleared
+
+
+def test_stopped_broadcast_picks_up_where_it_stopped():
+    copying_bot = CopyingBot(fail=[104])
+    results = []
+    broadcast = Broadcast(copying_bot, DirectOutbound(), 1, 2, list(range(100, 150)), 1,
+                          on_result=lambda chat_id, error: results.append((chat_id, error is None)))
+    broadcast.save_job()
+
+    async def stop_early():
+        task = asyncio.create_task(broadcast.run())
+        while len(copying_bot.sent) < 10:
+            await asyncio.sleep(0)
+        broadcast.stop()
+        await task
+
+    asyncio.run(stop_early())
+    assert not broadcast.finished
+    assert (104, False) in results
+
+    resumed_bot = CopyingBot()
+    resumed = Broadcast.load(resumed_bot, DirectOutbound())
+    assert resumed.position == broadcast.position and resumed.done_after == broadcast.done_after
+    asyncio.run(resumed.run())
+
+    assert sorted(copying_bot.sent + resumed_bot.sent) == list(range(100, 150))
+    assert resumed.finished
+    assert (resumed.sent, resumed.failed) == (49, 1)
+
+
+def test_progress_is_contiguous_with_out_of_order_completions():
+    broadcast = Broadcast(None, None, 1, 2, list(range(10)), 1)
+    for index in (1, 2, 4):
+        broadcast.mark_done(index)
+    assert (broadcast.position, broadcast.done_after) == (0, {1, 2, 4})
+    broadcast.mark_done(0)
+    assert (broadcast.position, broadcast.done_after) == (3, {4})
+
+
+def test_clear_removes_the_job(tmp_path):
+    Broadcast(None, None, 1, 2, [5, 6], 1).save_job()
+    assert (tmp_path / broadcast_engine.BROADCAST_JOB_FILE).exists()
+    assert (tmp_path / broadcast_engine.BROADCAST_PROGRESS_FILE).exists()
+    Broadcast.clear()
+    assert not (tmp_path / broadcast_engine.BROADCAST_JOB_FILE).exists()
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from Copyrightsaver_bot import ChatConfig, ChatConfigTable, DEFAULT_AUTO_DELETE_TIME
+
+
+def test_chats_without_settings_share_the_default():
+    table = ChatConfigTable()
+    assert table.get(-100) is table.get(-200) is table.default
+    assert table.default == ChatConfig(DEFAULT_AUTO_DELETE_TIME, True)
+    assert len(table) == 0
+
+
+def test_preload_takes_string_keys_from_json():
+    settings = json.loads(json.dumps({-100: {"delete_timer": "60", "auto_delete": False}, -200: {}}))
+    table = ChatConfigTable()
+    table.preload(settings.items())
+
+    assert table.get(-100) == ChatConfig(60, False)
+    assert table.get(-200) == table.default and table.get(-200) is not table.default
+    assert "-100" not in table.configs
+    assert table.to_dict() == {-100: {"delete_timer": 60, "auto_delete": False},
+                               -200: {"delete_timer": DEFAULT_AUTO_DELETE_TIME, "auto_delete": True}}
+
+
+def test_update_copies_instead_of_changing_the_default():
+    table = ChatConfigTable()
+    config = table.update("-100", delete_timer=60)
+
+    assert table.get(-100) is config and config == ChatConfig(60, True)
+    assert table.default.delete_timer == DEFAULT_AUTO_DELETE_TIME
+    assert table.update(-100, auto_delete=False) == ChatConfig(60, False)
+
+
+def test_configs_are_immutable():
+    config = ChatConfig()
+    with pytest.raises(AttributeError):
+        config.delete_timer = 5
+    assert ChatConfig.from_dict(config.to_dict()) == config
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+
+import pytest
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import Copyrightsaver_bot as bot
+from outbound_queue import OutboundQueue
+
+
+# Deletion heap
+
+def test_deletion_entries_round_trip():
+    for due_ts, chat_id, message_id in [(time.time() + 1800.3, -1001234567890, 2**31 - 1),
+                                        (time.time(), 2**52 - 1, 0), (0.0, -(2**52), 1)]:
+        unpacked = bot.unpack_deletion(bot.pack_deletion(due_ts, chat_id, message_id))
+        assert unpacked[0] == pytest.approx(due_ts, abs=0.05)
+        assert unpacked[1:] == (chat_id, message_id)
+
+
+def test_due_deletions_come_out_oldest_first_by_chat(state):
+    bot.schedule_deletion(-100, 3, -5)
+    bot.schedule_deletion(-100, 1, -10)
+    bot.schedule_deletion(-200, 2, -7)
+    bot.schedule_deletion(-200, 2, -6)  # Edited twice, deleted once
+    bot.schedule_deletion(-100, 4, 60)
+
+    assert bot.pop_due_deletions(time.time()) == {-100: [1, 3], -200: [2]}
+    assert [bot.unpack_deletion(entry)[1:] for entry in bot.pending_deletions] == [(-100, 4)]
+
+
+def test_due_deletions_are_taken_in_passes(state):
+    for message_id in range(10):
+        bot.schedule_deletion(-100, message_id, -10 + message_id)
+
+    assert bot.pop_due_deletions(time.time(), limit=4) == {-100: [0, 1, 2, 3]}
+    assert len(bot.pending_deletions) == 6
+
+
+def test_pending_deletions_survive_restart(state):
+    bot.schedule_deletion(-100, 1, 60)
+    bot.schedule_deletion(-200, 2, 30)
+    saved = sorted(bot.pending_deletions)
+    bot.save_deletions()
+    bot.pending_deletions.clear()
+
+    bot.load_deletions()
+    assert sorted(bot.pending_deletions) == saved
+
+
+def test_old_deletions_file_still_loads(state):
+    due_ts = time.time() + 60
+    (state / bot.DELETIONS_FILE).write_text(json.dumps([[due_ts, -100, 5]]))
+
+    bot.load_deletions()
+    assert bot.unpack_deletion(bot.pending_deletions[0])[1:] == (-100, 5)
+
+
+# Deletion batches
+
+class DeletingBot:
+    def __init__(self, fail):
+        self.fail = fail  # message_ids -> exception or None
+        self.calls = []
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.calls.append(list(message_ids))
+        error = self.fail(message_ids)
+        if error:
+            raise error
+
+
+def delete(monkeypatch, fail, message_ids=range(1, 101)):
+    deleting_bot = DeletingBot(fail)
+    before = dict(bot.deletion_metrics)
+
+    async def run():
+        outbound = OutboundQueue(rate=1000)
+        monkeypatch.setattr(bot, "outbound", outbound)
+        outbound.start()
+        await bot.delete_batch(deleting_bot, -100, list(message_ids))
+        await outbound.stop()
+
+    asyncio.run(run())
+    deleted = bot.deletion_metrics["messages"] - before["messages"]
+    failed = bot.deletion_metrics["failed"] - before["failed"]
+    return deleting_bot.calls, deleted, failed
+
+
+def test_batch_is_split_to_isolate_a_bad_message(state, monkeypatch):
+    calls, deleted, failed = delete(monkeypatch, lambda ids: BadRequest("Message can't be deleted") if 37 in ids else None)
+    assert len(calls) < 20  # About two per halving, not one per message
+    assert (deleted, failed) == (99, 1)
+
+
+def test_chat_wide_error_is_not_split(state, monkeypatch):
+    calls, deleted, failed = delete(monkeypatch, lambda ids: BadRequest("Not enough rights to delete messages"))
+    assert (len(calls), deleted, failed) == (1, 0, 100)
+
+
+def test_uniform_error_stops_splitting(state, monkeypatch):
+    calls, deleted, failed = delete(monkeypatch, lambda ids: BadRequest("Message can't be deleted"))
+    assert len(calls) < 20
+    assert (deleted, failed) == (0, 100)
+
+
+def test_forbidden_drops_the_batch_and_marks_the_chat_dead(state, monkeypatch):
+    calls, deleted, failed = delete(monkeypatch, lambda ids: Forbidden("Forbidden: bot was kicked from the group chat"))
+    assert (len(calls), deleted, failed) == (1, 0, 100)
+    assert bot.is_dead_chat(-100)
+
+
+def test_retry_after_puts_the_batch_back(state, monkeypatch):
+    calls, deleted, failed = delete(monkeypatch, lambda ids: RetryAfter(30))
+    assert (len(calls), deleted, failed) == (1, 0, 0)
+    assert len(bot.pending_deletions) == 100
+
+def test_due_deletions_are_coalesced_per_chat(state, monkeypatch):
+    deleting_bot = DeletingBot(lambda ids: None)
+    for message_id in range(250):
+        bot.schedule_deletion(-100, message_id, -1)
+    for message_id in range(3):
+        bot.schedule_deletion(-200, message_id, -1)
+
+    async def run():
+        outbound = OutboundQueue(rate=1000)
+        monkeypatch.setattr(bot, "outbound", outbound)
+        outbound.start()
+        await bot.delete_due_messages(deleting_bot, bot.pop_due_deletions(time.time()))
+        await outbound.stop()
+
+    asyncio.run(run())
+    assert sorted(map(len, deleting_bot.calls)) == [3, 50, 100, 100]
@@ -0,0 +1,68 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+
+import Copyrightsaver_bot as bot
+from fake_telegram import make_message_update, make_user
+
+
+def classify(update):
+    route, message = bot.classify_update(Update.de_json(update, None), "Fake_Bot")
+    return route
+
+
+@pytest.mark.parametrize("text, route", [
+    ("hello", "new"),
+    ("/start", "command"),
+    ("/settimer 5", "command"),
+    ("/start@fake_bot", "command"),  # Usernames don't care about case
+    ("/start@otherbot", "new"),  # Meant for another bot in the group
+    ("/unknown", "new"),
+    ("hello /start", "new"),  # Only a command at the start counts
+])
+def test_messages_are_classified(text, route):
+    assert classify(make_message_update(-100, 42, 1, text)) == route
+
+
+def test_edits_photos_and_new_members():
+    assert classify(make_message_update(-100, 42, 1, "/start", edited=True)) == "edited"
+    assert classify(make_message_update(-100, 42, 1, "/start", photo=True)) == "new"  # A caption isn't a command
+
+    update = make_message_update(-100, 42, 1)
+    update["message"]["new_chat_members"] = [make_user(43)]
+    assert classify(update) == "new_members"
+
+
+def test_other_updates_are_ignored():
+    assert classify({"update_id": 1, "channel_post": make_message_update(-100, 42, 1)["message"]}) is None
+
+
+def test_malformed_updates_are_dropped():
+    message = make_message_update(-100, 42, 1)
+    del message["message"]["date"]
+    bodies = ["not json", "[]", "{}", json.dumps(message), json.dumps(make_message_update(-100, 42, 2))]
+    application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+
+    async def main():
+        for body in bodies:
+            await bot.put_raw_update(application, body)
+
+    asyncio.run(main())
+    assert application.update_queue.qsize() == 1
+    assert application.update_queue.get_nowait().message.message_id == 2
+
+
+def test_failed_forwarded_call_is_only_logged():
+    bot.run_shard_call("no_such_call", (42,))
+
+
+def test_command_list_matches_the_handlers():
+    application = bot.build_application()
+    handled = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handled.update(getattr(handler, "commands", ()))
+    assert handled == bot.BOT_COMMANDS
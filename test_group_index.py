@@ -0,0 +1,19 @@
+from types import SimpleNamespace
+
+import Copyrightsaver_bot as bot
+
+
+def group(chat_id):
+    return SimpleNamespace(id=chat_id, title=f"Group {chat_id}", type="supergroup")
+
+
+def test_summary_counts_only_groups_the_bot_is_in(state):
+    for chat_id in (-100, -200, -400):
+        bot.add_group(chat_id)
+    for chat_id in (-100, -200, -300):  # -300 was never recorded
+        bot.note_group_activity(group(chat_id))
+    bot.mark_dead(-200, "Forbidden: bot was kicked")
+
+    assert -200 not in bot.group_index
+    assert bot.group_summary(None, None) == {"groups": 1, "admins": 0, "members": 0, "pending": 1}  # -400 has no entry
+    assert bot.user_summary(None)["groups"] == 1
@@ -0,0 +1,71 @@
+import asyncio
+
+from metrics import Counter, Histogram, CallbackMetric, MetricsServer, Registry
+
+
+def test_quantile_is_the_bucket_bound_capped_at_the_max():
+    histogram = Histogram("latency", "Latency", buckets=(0.1, 1, 10), registry=Registry())
+    for value in [0.05] * 90 + [0.5] * 9 + [3]:
+        histogram.observe(value)
+
+    assert histogram.count() == 100
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.95) == 1
+    assert histogram.quantile(1.0) == 3  # The 10 bucket is capped at the largest value seen
+    assert histogram.max() == 3
+
+
+def test_quantile_merges_label_values_unless_given():
+    histogram = Histogram("route_seconds", "Per route", ("route",), buckets=(0.1, 1), registry=Registry())
+    histogram.observe(0.05, "new")
+    histogram.observe(0.5, "edited")
+
+    assert histogram.count() == 2 and histogram.count("new") == 1
+    assert histogram.quantile(0.99, "new") == 0.05
+    assert histogram.quantile(0.99) == 0.5
+    assert histogram.quantile(0.5, "missing") == 0.0
+
+
+def test_render_in_the_prometheus_text_format():
+    registry = Registry()
+    counter = Counter("api_errors_total", "Failed calls", ("method",), registry=registry)
+    counter.inc('send"Message')
+    counter.inc('send"Message', amount=2)
+    histogram = Histogram("save_seconds", "Save time", buckets=(0.5,), registry=registry)
+    histogram.observe(0.25)
+    histogram.observe(2)
+    CallbackMetric("queued", "Queued", "gauge", lambda: {"delete": 3}, ("priority",), registry=registry)
+
+    assert registry.render().splitlines() == [
+        "# HELP api_errors_total Failed calls",
+        "# TYPE api_errors_total counter",
+        'api_errors_total{method="send\\"Message"} 3',
+        "# HELP save_seconds Save time",
+        "# TYPE save_seconds histogram",
+        'save_seconds_bucket{le="0.5"} 1',
+        'save_seconds_bucket{le="+Inf"} 2',
+        "save_seconds_sum 2.25",
+        "save_seconds_count 2",
+        "# HELP queued Queued",
+        "# TYPE queued gauge",
+        'queued{priority="delete"} 3',
+    ]
+
+
+def test_metrics_endpoint():
+    registry = Registry()
+    Counter("updates_total", "Updates", registry=registry).inc()
+
+    async def get(path):
+        server = MetricsServer("127.0.0.1", 0, registry)
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        await server.stop()
+        return response.decode()
+
+    response = asyncio.run(get("/metrics"))
+    assert response.startswith("HTTP/1.1 200") and response.endswith("updates_total 1\n")
+    assert asyncio.run(get("/other")).startswith("HTTP/1.1 404")
@@ -0,0 +1,163 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+import Copyrightsaver_bot as bot
+import outbound_queue
+from outbound_queue import OutboundQueue, DELETE, SEND, BULK, READ, SEND_QUEUE_LIMIT
+
+
+def run(main):
+    async def with_queue():
+        outbound = OutboundQueue(rate=1000)
+        outbound.start()
+        try:
+            return await main(outbound)
+        finally:
+            await outbound.stop()
+    return asyncio.run(with_queue())
+
+
+# A call that records (name, time) when it runs and raises the errors, one per run, before it succeeds
+def recorder(calls, name, errors=()):
+    errors = list(errors)
+
+    async def call():
+        calls.append((name, time.monotonic()))
+        if errors:
+            raise errors.pop(0)
+        return name
+    return call
+
+
+def names(calls):
+    return [name for name, _ in calls]
+
+
+def test_chats_take_turns():
+    calls = []
+
+    async def main(outbound):
+        futures = [outbound.enqueue(-1, DELETE, recorder(calls, f"noisy {i}")) for i in range(5)]
+        futures.append(outbound.enqueue(-2, DELETE, recorder(calls, "quiet")))
+        await asyncio.gather(*futures)
+
+    run(main)
+    assert names(calls).index("quiet") <= 1
+
+
+def test_priorities_are_served_in_order():
+    calls = []
+
+    async def main(outbound):
+        await asyncio.gather(*(
+            outbound.enqueue(-priority - 1, priority, recorder(calls, priority))
+            for priority in (READ, BULK, SEND, DELETE)
+        ))
+
+    run(main)
+    assert names(calls) == [DELETE, SEND, BULK, READ]
+
+
+def test_sends_to_a_chat_are_spaced(monkeypatch):
+    monkeypatch.setattr(outbound_queue, "GROUP_SEND_INTERVAL", 0.2)
+    calls = []
+
+    async def main(outbound):
+        await asyncio.gather(*(outbound.enqueue(-1, SEND, recorder(calls, "send")) for _ in range(2)))
+        await asyncio.gather(*(outbound.enqueue(-2, READ, recorder(calls, "read")) for _ in range(2)))
+
+    run(main)
+    (_, first), (_, second), (_, read_first), (_, read_second) = calls
+    assert second - first >= 0.2
+    assert read_second - read_first < 0.1
+
+
+def test_retry_after_pauses_only_that_chat():
+    calls = []
+
+    async def main(outbound):
+        limited = outbound.enqueue(-1, SEND, recorder(calls, "limited", [RetryAfter(1)]))
+        await asyncio.sleep(0.1)
+        await outbound.submit(-2, SEND, recorder(calls, "other"))
+        assert names(calls) == ["limited", "other"]
+        return await limited
+
+    started = time.monotonic()
+    assert run(main) == "limited"
+    assert names(calls) == ["limited", "other", "limited"]
+    assert calls[-1][1] - started >= 1
+
+
+def test_full_chat_queue_refuses_new_sends():
+    async def main(outbound):
+        futures = [outbound.enqueue(-1, SEND, recorder([], "send")) for _ in range(SEND_QUEUE_LIMIT + 1)]
+        with pytest.raises(asyncio.QueueFull):
+            await futures[-1]
+        assert not futures[-2].done()
+        assert await outbound.submit(-1, DELETE, recorder([], "delete")) == "delete"  # Deletions aren't limited
+
+    run(main)
+
+
+# Send results
+
+def test_transient_errors_never_mark_a_chat_dead(state):
+    bot.add_group(-100)
+    for error in (asyncio.QueueFull(), TimedOut(), RetryAfter(5),
+                  BadRequest("Not enough rights to send text messages to the chat")):
+        for _ in range(bot.DEAD_AFTER_FAILURES):
+            bot.record_send_result(-100, error)
+    assert not bot.is_dead_chat(-100)
+    assert -100 not in bot.send_failures
+
+
+def test_repeated_unexplained_failures_mark_a_chat_dead(state):
+    bot.add_group(-100)
+    error = BadRequest("Message is too long")
+    for _ in range(bot.DEAD_AFTER_FAILURES - 1):
+        bot.record_send_result(-100, error)
+    bot.reactivate_chat(-100)  # Traffic from the chat starts the count over
+    for _ in range(bot.DEAD_AFTER_FAILURES - 1):
+        bot.record_send_result(-100, error)
+    assert not bot.is_dead_chat(-100)
+
+    bot.record_send_result(-100, error)
+    assert bot.is_dead_chat(-100)
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_marking_a_dead_chat_again_keeps_what_it_was(backend, state, monkeypatch):
+    if backend == "sqlite":
+        monkeypatch.setattr(bot, "STORAGE_BACKEND", "sqlite")
+        monkeypatch.setattr(bot, "store", None)
+        monkeypatch.setattr(bot, "state_loaded", False)
+        bot.load_state()
+    bot.add_group(-100)
+    bot.add_started_user(42)
+    bot.mark_dead(-100, "Forbidden: bot was kicked")
+    bot.mark_dead(-100, "Bad Request: chat not found")  # e.g. a broadcast send still in flight
+    bot.mark_dead(42, "Forbidden: bot was blocked by the user")
+    bot.mark_dead(42, "Forbidden: bot was blocked by the user")
+
+    bot.reactivate_chat(-100)
+    bot.reactivate_chat(42)
+    assert bot.get_group_chat_ids() == [-100]
+    assert sorted(bot.get_recipients()) == [-100, 42]
+    if bot.store:
+        bot.store.conn.close()
+
+
+def test_full_queue_doesnt_count_as_a_failed_send(state, monkeypatch):
+    monkeypatch.setattr(bot, "outbound", OutboundQueue())  # Not started, so nothing leaves the queue
+
+    async def main():
+        for _ in range(SEND_QUEUE_LIMIT + bot.DEAD_AFTER_FAILURES):
+            bot.queue_call(-100, SEND, recorder([], "send"), "send")
+        await asyncio.sleep(0)  # Let the done callbacks run
+
+    asyncio.run(main())
+    assert bot.outbound.metrics["dropped"] == bot.DEAD_AFTER_FAILURES
+    assert not bot.is_dead_chat(-100) and -100 not in bot.send_failures
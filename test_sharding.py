@@ -0,0 +1,81 @@
+import asyncio
+import json
+import queue
+import time
+
+import pytest
+
+import Copyrightsaver_bot as bot
+import sharding
+from sharding import Coordinator, shard_of, update_chat_id
+from fake_telegram import make_message_update
+
+
+def test_updates_go_to_the_shard_of_their_chat():
+    assert shard_of(-1001234567890, 3) == -1001234567890 % 3
+    assert update_chat_id(make_message_update(-100123, 42, 1)) == -100123
+    assert update_chat_id(make_message_update(-100123, 42, 1, edited=True)) == -100123
+    assert update_chat_id({"callback_query": {"message": {"chat": {"id": 42}}}}) == 42
+    assert update_chat_id({"update_id": 1, "poll": {}}) == 0
+
+
+def test_split_into_shards(state):
+    chat_ids = [-1001000000000 - i for i in range(6)]
+    (state / bot.DATA_FILE).write_text(json.dumps({
+        "started_users": [1, 2, 3],
+        "group_ids": chat_ids,
+        "global_authorized_users": [7],
+        "group_settings": {str(chat_id): {"delete_timer": 60, "auto_delete": True} for chat_id in chat_ids},
+    }))
+    (state / bot.DELETIONS_FILE).write_text(json.dumps([[time.time() + 60, chat_id, 1] for chat_id in chat_ids]))
+    bot.state_loaded = False
+    bot.split_into_shards(3)
+
+    for shard in range(3):
+        with open(bot.shard_file(bot.DATA_FILE, shard)) as f:
+            data = json.load(f)
+        assert data["global_authorized_users"] == [7]
+        assert all(shard_of(chat_id, 3) == shard for chat_id in data["started_users"] + data["group_ids"])
+        assert all(shard_of(chat_id, 3) == shard for chat_id in data["group_settings"])
+        assert len(data["group_ids"]) == 2
+        deletions = bot.read_deletions(bot.shard_file(bot.DELETIONS_FILE, shard))
+        assert sorted(bot.unpack_deletion(entry)[1] for entry in deletions) == sorted(data["group_ids"])
+
+
+def test_unsharded_start_refuses_split_state(state):
+    bot.split_into_shards(3)
+    bot.state_loaded = False
+    with pytest.raises(SystemExit, match="WEBHOOK_SHARDS=3"):
+        bot.load_state()
+
+
+# Coordinator
+
+def test_query_fails_when_a_shard_inbox_is_full():
+    inboxes = [queue.Queue(1), queue.Queue(1)]
+    inboxes[1].put("update")
+    coordinator = Coordinator(inboxes, queue.Queue())
+
+    with pytest.raises(RuntimeError, match="Shard 1"):
+        asyncio.run(coordinator.query("users"))
+    assert not coordinator.pending
+
+
+def test_forwarded_call_waits_for_room(monkeypatch):
+    monkeypatch.setattr(sharding, "FORWARD_RETRY_DELAY", 0.01)
+    inbox = queue.Queue(1)
+    inbox.put("update")
+    outbox = queue.Queue()
+    coordinator = Coordinator([inbox], outbox)
+
+    async def main():
+        coordinator.start()
+        outbox.put(("forward", 42, "add_started_user", (42,)))
+        await asyncio.sleep(0.05)
+        assert inbox.get_nowait() == "update"  # The shard catches up
+        while coordinator.retries:
+            await asyncio.sleep(0.01)
+        await coordinator.stop()
+
+    asyncio.run(main())
+    assert inbox.get_nowait() == ("call", "add_started_user", (42,))
@@ -0,0 +1,45 @@
+import json
+import logging
+import queue
+
+from structured_log import DroppingQueueHandler, JsonFormatter, RateLimitFilter
+
+
+def make_record(msg, created, *args, **extra):
+    record = logging.LogRecord("bot", logging.INFO, __file__, 1, msg, args, None)
+    record.created = created
+    record.__dict__.update(extra)
+    return record
+
+
+def test_rate_limit_lets_a_burst_through_per_window():
+    rate_limit = RateLimitFilter(burst=2, window=60)
+    passed = [rate_limit.filter(make_record("Deleted %s", 1000 + i, i)) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert rate_limit.suppressed == 3
+
+    other = make_record("Sent %s", 1004, 1)  # Templates are limited separately
+    assert rate_limit.filter(other) and not hasattr(other, "suppressed")
+
+    record = make_record("Deleted %s", 1060, 5)  # Next window
+    assert rate_limit.filter(record)
+    assert record.suppressed == 3
+    later = make_record("Deleted %s", 1061, 6)
+    assert rate_limit.filter(later) and not hasattr(later, "suppressed")
+    assert not rate_limit.filter(make_record("Deleted %s", 1062, 7))
+    assert rate_limit.suppressed == 4
+
+
+def test_json_lines_carry_the_extra_fields():
+    record = make_record("Deleted %s", 1000.12345, 7, chat_id=-100, message_id=7)
+    entry = json.loads(JsonFormatter({"shard": 1}).format(record))
+    assert entry == {"time": 1000.123, "level": "INFO", "logger": "bot", "message": "Deleted 7",
+                     "shard": 1, "chat_id": -100, "message_id": 7}
+
+
+def test_full_queue_drops_records():
+    handler = DroppingQueueHandler(queue.Queue(2))
+    for i in range(5):
+        handler.handle(make_record("Deleted %s", 1000, i))
+    assert handler.dropped == 3
+    assert handler.queue.get_nowait().msg == "Deleted 0"  # Rendered before crossing threads
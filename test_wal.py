@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+import Copyrightsaver_bot as bot
+
+
+def flush_wal():
+    async def flush():
+        await bot.flush_wal(asyncio.get_running_loop())
+    asyncio.run(flush())
+
+
+def test_wal_replay_restores_changes(state):
+    bot.add_started_user(5)
+    bot.authorize_global(7)
+    bot.authorize_in_group(-100, 8)
+    bot.update_group_config(-100, delete_timer=60)
+    bot.mark_dead(5, "blocked")
+    bot.add_started_user(6)
+    flush_wal()
+    with open(bot.WAL_FILE, "a") as f:
+        f.write('["add", "started_us')  # Cut off by a crash
+
+    # Start over from the files
+    bot.group_settings.configs.clear()
+    bot.load_json_state()
+    assert bot.started_users == {6}
+    assert bot.dead_chats[5][0] == "blocked"
+    assert bot.auth_index.is_exempt(-200, 7)
+    assert bot.auth_index.is_exempt(-100, 8) and not bot.auth_index.is_exempt(-200, 8)
+    assert bot.get_group_config(-100).delete_timer == 60
+
+
+def test_failed_wal_write_keeps_the_lines(state, monkeypatch):
+    def disk_full(lines):
+        raise OSError("No space left on device")
+
+    bot.add_started_user(5)
+    with monkeypatch.context() as patch:
+        patch.setattr(bot, "append_wal", disk_full)
+        flush_wal()
+    assert len(bot.wal_buffer) == 1
+
+    flush_wal()  # Writes a snapshot, the failed append may have left half a line
+    assert not bot.wal_buffer
+    with open(bot.DATA_FILE) as f:
+        assert json.load(f)["started_users"] == [5]
+
+
+def test_long_wal_is_folded_into_a_snapshot(state, monkeypatch):
+    monkeypatch.setattr(bot, "WAL_COMPACT_ENTRIES", 3)
+    bot.add_started_user(5)
+    flush_wal()
+    assert (state / bot.WAL_FILE).read_text().count("\n") == 1
+
+    bot.add_started_user(6)
+    bot.add_started_user(7)
+    flush_wal()
+    assert (state / bot.WAL_FILE).read_text() == ""
+    with open(bot.DATA_FILE) as f:
+        assert sorted(json.load(f)["started_users"]) == [5, 6, 7]
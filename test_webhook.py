@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+from fake_telegram import FakeTelegram, SECRET_TOKEN, make_message_update, post_update, start_bot
+
+
+async def wait_until(condition, timeout=15):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+def sent_to(fake, chat_id):
+    return [params for params in fake.calls_to("sendMessage") if params["chat_id"] == chat_id]
+
+
+# Runs the bot against the fake Bot API the way fake_telegram.py does and checks the calls it made
+@pytest.mark.parametrize("shards", [1, 3])
+def test_webhook_end_to_end(shards, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    starts = [make_message_update(chat_id, user_id, 1, "/start")
+              for chat_id, user_id in ((-100123, 42), (-100124, 43), (-100125, 44))]
+    message = make_message_update(-100123, 42, 2, "hello")
+    edit = make_message_update(-100123, 42, 2, "hello again", edited=True)
+    forged_edit = make_message_update(-100124, 43, 1, "forged", edited=True)
+
+    async def main():
+        fake = FakeTelegram()
+        await fake.start()
+        bot_module, url, stop_bot = await start_bot(fake, shards)
+        owner_id = int(bot_module.OWNER_ID)
+        try:
+            statuses = [await post_update(url, update, SECRET_TOKEN) for update in [*starts, message, edit]]
+            assert statuses == [200] * 5
+            assert await post_update(url, forged_edit, "wrong-secret") == 403
+            assert await post_update(url, forged_edit) == 403
+
+            assert await wait_until(lambda: all(sent_to(fake, update["message"]["chat"]["id"]) for update in starts))
+            assert await wait_until(lambda: fake.calls_to("deleteMessages") and len(sent_to(fake, -100123)) > 1)
+            await post_update(url, make_message_update(owner_id, owner_id, 1, "/countuser"), SECRET_TOKEN)
+            assert await wait_until(lambda: sent_to(fake, owner_id))
+        finally:
+            await stop_bot()
+            await fake.stop()
+        return fake, owner_id
+
+    fake, owner_id = asyncio.run(main())
+
+    # Each /start in a group is answered with a reply to it
+    for update in starts:
+        reply = sent_to(fake, update["message"]["chat"]["id"])[0]
+        assert reply["reply_parameters"] == {"message_id": 1}
+
+    # The edited message is deleted and announced, the forged edit is not
+    assert fake.calls_to("deleteMessages") == [{"chat_id": -100123, "message_ids": [2]}]
+    assert any("User 42" in params["text"] for params in sent_to(fake, -100123)[1:])
+    assert len(sent_to(fake, -100124)) == 1
+
+    # Owner commands count across every shard
+    [count] = sent_to(fake, owner_id)
+    assert count["text"].startswith("Total number of users who started the bot: 3\n")
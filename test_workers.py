@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+import Copyrightsaver_bot as bot
+from broadcast_engine import write_json
+
+
+def deletion_chats(path):
+    return sorted(bot.unpack_deletion(entry)[1] for entry in bot.read_deletions(path))
+
+
+def test_deletions_follow_the_number_of_workers(state):
+    due = time.time() + 60
+    write_json(bot.DELETIONS_FILE, [bot.pack_deletion(due, -100, 1)])  # Left by a polling run
+    write_json(bot.shard_file(bot.DELETIONS_FILE, 3), [bot.pack_deletion(due, -101, 1)])  # By a fourth worker
+
+    bot.redistribute_deletions(2)
+    assert not (state / bot.DELETIONS_FILE).exists()
+    assert not (state / bot.shard_file(bot.DELETIONS_FILE, 3)).exists()
+    assert deletion_chats(bot.shard_file(bot.DELETIONS_FILE, 0)) == [-100]
+    assert deletion_chats(bot.shard_file(bot.DELETIONS_FILE, 1)) == [-101]
+
+    bot.redistribute_deletions(1)
+    assert deletion_chats(bot.DELETIONS_FILE) == [-101, -100]
+    assert not (state / bot.shard_file(bot.DELETIONS_FILE, 0)).exists()
+
+
+def test_worker_zero_adds_the_reports_of_the_others(state, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_WORKERS", 2)
+    monkeypatch.setattr(bot, "WORKER_ID", 1)
+    bot.add_group(-100)
+    bot.pending_deletions.append(bot.pack_deletion(time.time() + 60, -100, 1))
+    bot.group_index[-100] = {"title": "Group", "type": "supergroup", "last_active": time.time()}
+    bot.write_worker_report(None)
+
+    monkeypatch.setattr(bot, "WORKER_ID", 0)
+    monkeypatch.setattr(bot, "pending_deletions", [])
+    monkeypatch.setattr(bot, "group_index", {})
+    stats = asyncio.run(bot.collect(None, "stats"))
+    assert stats["counts"]["pending_deletions"] == 1
+    assert asyncio.run(bot.collect(None, "groups", 1))["groups"] == 1  # Active today on worker 1
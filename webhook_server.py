@@ -0,0 +1,107 @@
+import asyncio
+import hmac
+
+# Minimal asyncio HTTP server for Telegram webhooks.
+# Telegram only ever sends small JSON POSTs, so this reads the request line,
+# headers and a Content-Length body, checks the secret token header and hands
+# the raw body to on_update. No extra dependencies are needed.
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY_SIZE = 1024 * 1024  # Telegram updates are far smaller than this
+
+
+async def read_http_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_SIZE:
+        raise ValueError(f"Request body of {length} bytes is too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def write_http_response(writer, status, body=b"", content_type="application/json"):
+    reasons = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 429: "Too Many Requests"}
+    writer.write(
+        f"HTTP/1.1 {status} {reasons.get(status, 'Error')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"\r\n".encode("latin-1") + body
+    )
+
+
+class WebhookServer:
+    def __init__(self, listen, port, path, secret_token, on_update):
+        # Without the token anyone who reaches the port could post updates as any user, the owner included
+        if not secret_token:
+            raise ValueError("A webhook needs a secret token")
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.on_update = on_update  # Coroutine function called with the raw JSON body, may raise ValueError
+        self.server = None
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+        # Port 0 picks a free port, report the one actually used
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    write_http_response(writer, 400)
+                    break
+                if request is None:
+                    break
+                status = await self.dispatch(*request)
+                write_http_response(writer, status)
+                await writer.drain()
+                if request[2].get("connection", "").lower() == "close":
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, headers, body):
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        # Constant-time comparison so the token can't be guessed byte by byte
+        if not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            self.rejected += 1
+            return 403
+        try:
+            # on_update can return a status of its own, e.g. 429 when its queue is full
+            status = await self.on_update(body) or 200
+        except ValueError:  # Malformed JSON
+            return 400
+        if status == 200:
+            self.received += 1
+        return status